@@ -16,3 +16,685 @@ ADD COLUMN accepted_answer_id integer REFERENCES answer(id);
 ALTER TABLE comment
 ADD COLUMN user_id integer REFERENCES user_data(id);
 
+
+-- question.version changes whenever something shown on the question page (apart from the view counter) changes,
+-- so it can be used to key cached page fragments
+ALTER TABLE question
+ADD COLUMN version integer NOT NULL DEFAULT 0;
+
+CREATE FUNCTION bump_own_question_version() RETURNS trigger AS $$
+BEGIN
+    IF (NEW.title, NEW.message, NEW.image, NEW.vote_number, NEW.user_id, NEW.accepted_answer_id)
+        IS DISTINCT FROM (OLD.title, OLD.message, OLD.image, OLD.vote_number, OLD.user_id, OLD.accepted_answer_id) THEN
+        NEW.version := OLD.version + 1;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER question_version BEFORE UPDATE ON question
+FOR EACH ROW EXECUTE PROCEDURE bump_own_question_version();
+
+CREATE FUNCTION bump_parent_question_version() RETURNS trigger AS $$
+DECLARE
+    changed_row record;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed_row := OLD;
+    ELSE
+        changed_row := NEW;
+    END IF;
+    UPDATE question SET version = version + 1 WHERE id = changed_row.question_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER question_version AFTER INSERT OR UPDATE OR DELETE ON answer
+FOR EACH ROW EXECUTE PROCEDURE bump_parent_question_version();
+
+CREATE TRIGGER question_version AFTER INSERT OR UPDATE OR DELETE ON comment
+FOR EACH ROW EXECUTE PROCEDURE bump_parent_question_version();
+
+CREATE TRIGGER question_version AFTER INSERT OR UPDATE OR DELETE ON question_tag
+FOR EACH ROW EXECUTE PROCEDURE bump_parent_question_version();
+
+-- every worker keeps its own cache of rows, so every write is announced on the askmate_invalidate channel
+-- with the table, the id, and the question and tag the row belongs to (see invalidation.py)
+CREATE FUNCTION notify_cache_invalidation() RETURNS trigger AS $$
+DECLARE
+    changed_row jsonb;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed_row := to_jsonb(OLD);
+    ELSE
+        changed_row := to_jsonb(NEW);
+    END IF;
+    -- view counter updates don't change the version and don't need to be announced
+    IF TG_TABLE_NAME = 'question' AND TG_OP = 'UPDATE' THEN
+        IF NEW.version = OLD.version THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+    PERFORM pg_notify('askmate_invalidate', json_build_object(
+        'table', TG_TABLE_NAME,
+        'id', changed_row -> 'id',
+        'question_id', changed_row -> 'question_id',
+        'tag_id', CASE WHEN TG_TABLE_NAME = 'tag' THEN changed_row -> 'id' ELSE changed_row -> 'tag_id' END
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cache_invalidation AFTER INSERT OR UPDATE OR DELETE ON question
+FOR EACH ROW EXECUTE PROCEDURE notify_cache_invalidation();
+
+CREATE TRIGGER cache_invalidation AFTER INSERT OR UPDATE OR DELETE ON answer
+FOR EACH ROW EXECUTE PROCEDURE notify_cache_invalidation();
+
+CREATE TRIGGER cache_invalidation AFTER INSERT OR UPDATE OR DELETE ON comment
+FOR EACH ROW EXECUTE PROCEDURE notify_cache_invalidation();
+
+CREATE TRIGGER cache_invalidation AFTER INSERT OR UPDATE OR DELETE ON question_tag
+FOR EACH ROW EXECUTE PROCEDURE notify_cache_invalidation();
+
+CREATE TRIGGER cache_invalidation AFTER INSERT OR UPDATE OR DELETE ON tag
+FOR EACH ROW EXECUTE PROCEDURE notify_cache_invalidation();
+
+-- browsing the questions by tag: tag.question_count is kept up to date by a trigger instead of being counted
+-- on every request, and the questions of a tag are read from the (tag_id, question_id) index
+CREATE INDEX question_tag_tag_id_question_id ON question_tag (tag_id, question_id);
+
+CREATE INDEX tag_name ON tag (name);
+
+ALTER TABLE tag
+ADD COLUMN question_count integer NOT NULL DEFAULT 0;
+
+UPDATE tag SET question_count = (SELECT COUNT(*) FROM question_tag WHERE question_tag.tag_id = tag.id);
+
+CREATE FUNCTION count_tag_questions() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE tag SET question_count = question_count - 1 WHERE id = OLD.tag_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE tag SET question_count = question_count + 1 WHERE id = NEW.tag_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tag_question_count AFTER INSERT OR UPDATE OR DELETE ON question_tag
+FOR EACH ROW EXECUTE PROCEDURE count_tag_questions();
+
+-- one row per user and voted question or answer. The counters (question.vote_number, answer.vote_number,
+-- user_data.reputation) are updated from it in batches, applied_value is the part of the vote already counted
+CREATE TABLE vote (
+    user_id integer NOT NULL REFERENCES user_data(id),
+    target_type varchar(8) NOT NULL CHECK (target_type IN ('question', 'answer')),
+    target_id integer NOT NULL,
+    value smallint NOT NULL CHECK (value IN (-1, 1)),
+    applied_value smallint NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, target_type, target_id)
+);
+
+CREATE INDEX vote_pending ON vote (target_type, target_id) WHERE value <> applied_value;
+
+-- for recomputing the reputations from the vote ledger, user by user
+CREATE INDEX vote_target ON vote (target_type, target_id);
+
+CREATE INDEX question_user_id ON question (user_id);
+
+CREATE INDEX answer_user_id ON answer (user_id);
+
+
+-- answer and comment are range partitioned by the month of submission_time, so the partitions of the recent months
+-- (and their indexes) are what the per-question and time ordered queries keep in memory, not the whole history.
+-- create_submission_time_partitions() adds the partitions of the coming months and
+-- archive_submission_time_partitions() moves the old ones to an archive tablespace (see batch_jobs.py)
+CREATE FUNCTION create_submission_time_partitions(parent text, first_month timestamp, last_month timestamp)
+RETURNS integer AS $$
+DECLARE
+    month timestamp := date_trunc('month', first_month);
+    partition_name text;
+    default_name text := parent || '_default';
+    has_default_rows boolean;
+    created integer := 0;
+BEGIN
+    WHILE month <= last_month LOOP
+        partition_name := parent || '_' || to_char(month, 'YYYY_MM');
+        IF to_regclass(partition_name) IS NULL THEN
+            has_default_rows := false;
+            IF to_regclass(default_name) IS NOT NULL THEN
+                EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE submission_time >= %L AND submission_time < %L)',
+                               default_name, month, month + interval '1 month')
+                INTO has_default_rows;
+            END IF;
+            IF has_default_rows THEN
+                -- the month's rows are in the default partition (e.g. the partition job didn't run in time): they are
+                -- moved to the new partition while both are detached, so no trigger fires for them. Locks the parent
+                -- table exclusively until the end of the transaction
+                EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS)', partition_name, parent);
+                EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', parent, default_name);
+                EXECUTE format('WITH moved AS (DELETE FROM %I WHERE submission_time >= %L AND submission_time < %L '
+                               'RETURNING *) INSERT INTO %I SELECT * FROM moved',
+                               default_name, month, month + interval '1 month', partition_name);
+                EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                               parent, partition_name, month, month + interval '1 month');
+                EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I DEFAULT', parent, default_name);
+            ELSE
+                EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                               partition_name, parent, month, month + interval '1 month');
+            END IF;
+            created := created + 1;
+        END IF;
+        month := month + interval '1 month';
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+-- moves the monthly partitions (and their indexes) of the months before before_month to archive_tablespace,
+-- e.g. one on a compressing file system. Rewrites every moved partition under an exclusive lock
+CREATE FUNCTION archive_submission_time_partitions(parent text, before_month timestamp, archive_tablespace text)
+RETURNS integer AS $$
+DECLARE
+    partition_row record;
+    index_name text;
+    moved integer := 0;
+BEGIN
+    FOR partition_row IN
+        SELECT child.oid, child.relname
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        LEFT JOIN pg_tablespace ON pg_tablespace.oid = child.reltablespace
+        WHERE pg_inherits.inhparent = parent::regclass AND
+              child.relname ~ ('^' || parent || '_\d{4}_\d{2}$') AND
+              to_timestamp(right(child.relname, 7), 'YYYY_MM') < date_trunc('month', before_month) AND
+              pg_tablespace.spcname IS DISTINCT FROM archive_tablespace
+        ORDER BY child.relname
+    LOOP
+        EXECUTE format('ALTER TABLE %I SET TABLESPACE %I', partition_row.relname, archive_tablespace);
+        FOR index_name IN SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = partition_row.oid LOOP
+            EXECUTE format('ALTER INDEX %s SET TABLESPACE %I', index_name, archive_tablespace);
+        END LOOP;
+        moved := moved + 1;
+    END LOOP;
+    RETURN moved;
+END;
+$$ LANGUAGE plpgsql;
+
+-- the primary keys of partitioned tables have to contain the partition key, so the foreign keys to answer(id) are
+-- moved to answer_key (below).
+-- The rows keep their submission_time, only the ones without one are moved to '-infinity' (the partition key can't
+-- be NULL), so an answer or comment may be older than its question: the per-question queries prune by
+-- question.oldest_post_time (below) instead of the question's submission_time
+ALTER TABLE comment DROP CONSTRAINT fk_answer_id;
+ALTER TABLE question DROP CONSTRAINT question_accepted_answer_id_fkey;
+
+ALTER TABLE answer RENAME TO answer_unpartitioned;
+ALTER TABLE comment RENAME TO comment_unpartitioned;
+ALTER SEQUENCE answer_id_seq OWNED BY NONE;
+ALTER SEQUENCE comment_id_seq OWNED BY NONE;
+
+CREATE TABLE answer (
+    id integer NOT NULL DEFAULT nextval('answer_id_seq'),
+    submission_time timestamp without time zone NOT NULL DEFAULT LOCALTIMESTAMP(0),
+    vote_number integer,
+    question_id integer,
+    message text,
+    image text,
+    user_id integer
+) PARTITION BY RANGE (submission_time);
+
+CREATE TABLE comment (
+    id integer NOT NULL DEFAULT nextval('comment_id_seq'),
+    question_id integer,
+    answer_id integer,
+    message text,
+    submission_time timestamp without time zone NOT NULL DEFAULT LOCALTIMESTAMP(0),
+    edited_count integer,
+    user_id integer
+) PARTITION BY RANGE (submission_time);
+
+-- rows outside of the created months (e.g. when the partition job didn't run) still have a place to go
+CREATE TABLE answer_default PARTITION OF answer DEFAULT;
+CREATE TABLE comment_default PARTITION OF comment DEFAULT;
+
+-- the months that have rows, and the coming ones
+SELECT create_submission_time_partitions('answer', month, month)
+FROM (SELECT DISTINCT date_trunc('month', submission_time) AS month FROM answer_unpartitioned) months
+WHERE month IS NOT NULL;
+SELECT create_submission_time_partitions('answer', LOCALTIMESTAMP, LOCALTIMESTAMP + interval '3 months');
+
+SELECT create_submission_time_partitions('comment', month, month)
+FROM (SELECT DISTINCT date_trunc('month', submission_time) AS month FROM comment_unpartitioned) months
+WHERE month IS NOT NULL;
+SELECT create_submission_time_partitions('comment', LOCALTIMESTAMP, LOCALTIMESTAMP + interval '3 months');
+
+INSERT INTO answer (id, submission_time, vote_number, question_id, message, image, user_id)
+SELECT answer.id,
+       COALESCE(answer.submission_time, '-infinity'),
+       answer.vote_number, answer.question_id, answer.message, answer.image, answer.user_id
+FROM answer_unpartitioned answer;
+
+INSERT INTO comment (id, question_id, answer_id, message, submission_time, edited_count, user_id)
+SELECT comment.id, comment.question_id, comment.answer_id, comment.message,
+       COALESCE(comment.submission_time, '-infinity'),
+       comment.edited_count, comment.user_id
+FROM comment_unpartitioned comment;
+
+DROP TABLE answer_unpartitioned;
+DROP TABLE comment_unpartitioned;
+ALTER SEQUENCE answer_id_seq OWNED BY answer.id;
+ALTER SEQUENCE comment_id_seq OWNED BY comment.id;
+
+ALTER TABLE answer
+ADD CONSTRAINT pk_answer_id PRIMARY KEY (id, submission_time),
+ADD CONSTRAINT fk_question_id FOREIGN KEY (question_id) REFERENCES question(id),
+ADD CONSTRAINT answer_user_id_fkey FOREIGN KEY (user_id) REFERENCES user_data(id);
+
+ALTER TABLE comment
+ADD CONSTRAINT pk_comment_id PRIMARY KEY (id, submission_time),
+ADD CONSTRAINT fk_question_id FOREIGN KEY (question_id) REFERENCES question(id),
+ADD CONSTRAINT comment_user_id_fkey FOREIGN KEY (user_id) REFERENCES user_data(id);
+
+CREATE INDEX answer_question_id ON answer (question_id);
+CREATE INDEX answer_user_id ON answer (user_id);
+CREATE INDEX comment_question_id ON comment (question_id);
+CREATE INDEX comment_answer_id ON comment (answer_id);
+CREATE INDEX comment_user_id ON comment (user_id);
+
+-- answer_key and comment_key map the ids to their submission_time, the partition key. They keep the ids unique (the ids
+-- only come from the sequences, an insert reusing one fails), answer_key is what comment.answer_id and
+-- question.accepted_answer_id reference, and the lookups by id read the submission_time from them so only the
+-- partition holding the row is scanned (see id_condition() in queries/select.py)
+CREATE TABLE answer_key (
+    id integer PRIMARY KEY,
+    submission_time timestamp without time zone NOT NULL
+);
+
+CREATE TABLE comment_key (
+    id integer PRIMARY KEY,
+    submission_time timestamp without time zone NOT NULL
+);
+
+INSERT INTO answer_key (id, submission_time) SELECT id, submission_time FROM answer;
+INSERT INTO comment_key (id, submission_time) SELECT id, submission_time FROM comment;
+
+ALTER TABLE comment
+ADD CONSTRAINT fk_answer_id FOREIGN KEY (answer_id) REFERENCES answer_key(id);
+
+ALTER TABLE question
+ADD CONSTRAINT question_accepted_answer_id_fkey FOREIGN KEY (accepted_answer_id) REFERENCES answer_key(id);
+
+-- the partitioned table is passed as an argument. An update of submission_time moving a row to another partition
+-- fires as a delete and an insert of the same id, so the row is looked up before its key is dropped or refused
+CREATE FUNCTION keep_partition_key() RETURNS trigger AS $$
+DECLARE
+    key_table text := TG_ARGV[0] || '_key';
+    rows_with_id integer;
+    inserted integer;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        EXECUTE format('SELECT COUNT(*) FROM %I WHERE id = $1', TG_ARGV[0]) INTO rows_with_id USING OLD.id;
+        IF rows_with_id = 0 THEN
+            EXECUTE format('DELETE FROM %I WHERE id = $1', key_table) USING OLD.id;
+        END IF;
+    ELSIF TG_OP = 'UPDATE' THEN
+        EXECUTE format('UPDATE %I SET id = $1, submission_time = $2 WHERE id = $3', key_table)
+        USING NEW.id, NEW.submission_time, OLD.id;
+    ELSE
+        EXECUTE format('INSERT INTO %I (id, submission_time) VALUES ($1, $2) ON CONFLICT (id) DO NOTHING', key_table)
+        USING NEW.id, NEW.submission_time;
+        GET DIAGNOSTICS inserted = ROW_COUNT;
+        IF inserted = 0 THEN
+            EXECUTE format('SELECT COUNT(*) FROM %I WHERE id = $1', TG_ARGV[0]) INTO rows_with_id USING NEW.id;
+            IF rows_with_id > 1 THEN
+                RAISE unique_violation USING MESSAGE = format('%s id %s already exists', TG_ARGV[0], NEW.id);
+            END IF;
+            EXECUTE format('UPDATE %I SET submission_time = $1 WHERE id = $2', key_table)
+            USING NEW.submission_time, NEW.id;
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER partition_key AFTER INSERT OR UPDATE OF id, submission_time OR DELETE ON answer
+FOR EACH ROW EXECUTE PROCEDURE keep_partition_key('answer');
+
+CREATE TRIGGER partition_key AFTER INSERT OR UPDATE OF id, submission_time OR DELETE ON comment
+FOR EACH ROW EXECUTE PROCEDURE keep_partition_key('comment');
+
+-- no answer or comment of the question is older than question.oldest_post_time (NULL while it has none), so the
+-- per-question queries skip the partitions of the months before it. Only lowered, which new posts rarely need
+ALTER TABLE question
+ADD COLUMN oldest_post_time timestamp without time zone;
+
+UPDATE question SET oldest_post_time = post.oldest
+FROM (
+    SELECT question_id, MIN(submission_time) AS oldest
+    FROM (SELECT question_id, submission_time FROM answer
+          UNION ALL
+          SELECT question_id, submission_time FROM comment) posts
+    GROUP BY question_id
+) post
+WHERE question.id = post.question_id;
+
+CREATE FUNCTION lower_oldest_post_time() RETURNS trigger AS $$
+BEGIN
+    UPDATE question SET oldest_post_time = NEW.submission_time
+    WHERE id = NEW.question_id AND (oldest_post_time IS NULL OR oldest_post_time > NEW.submission_time);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER oldest_post_time AFTER INSERT OR UPDATE OF submission_time, question_id ON answer
+FOR EACH ROW EXECUTE PROCEDURE lower_oldest_post_time();
+
+CREATE TRIGGER oldest_post_time AFTER INSERT OR UPDATE OF submission_time, question_id ON comment
+FOR EACH ROW EXECUTE PROCEDURE lower_oldest_post_time();
+
+-- the triggers fire on the partitions, so the notified table name is passed as an argument instead of TG_TABLE_NAME.
+-- text_changed tells the workers that a row got a title or message it didn't have, which any cached search may
+-- match (see search_cache.py)
+CREATE OR REPLACE FUNCTION notify_cache_invalidation() RETURNS trigger AS $$
+DECLARE
+    changed_row jsonb;
+    table_name text := COALESCE(TG_ARGV[0], TG_TABLE_NAME);
+    text_changed boolean := TG_OP = 'INSERT';
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed_row := to_jsonb(OLD);
+    ELSE
+        changed_row := to_jsonb(NEW);
+    END IF;
+    IF TG_OP = 'UPDATE' THEN
+        text_changed := (changed_row -> 'title', changed_row -> 'message')
+                        IS DISTINCT FROM (to_jsonb(OLD) -> 'title', to_jsonb(OLD) -> 'message');
+    END IF;
+    -- view counter updates don't change the version and don't need to be announced
+    IF table_name = 'question' AND TG_OP = 'UPDATE' THEN
+        IF NEW.version = OLD.version THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+    PERFORM pg_notify('askmate_invalidate', json_build_object(
+        'table', table_name,
+        'id', changed_row -> 'id',
+        'question_id', changed_row -> 'question_id',
+        'tag_id', CASE WHEN table_name = 'tag' THEN changed_row -> 'id' ELSE changed_row -> 'tag_id' END,
+        'text_changed', text_changed
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER question_version AFTER INSERT OR UPDATE OR DELETE ON answer
+FOR EACH ROW EXECUTE PROCEDURE bump_parent_question_version();
+
+CREATE TRIGGER question_version AFTER INSERT OR UPDATE OR DELETE ON comment
+FOR EACH ROW EXECUTE PROCEDURE bump_parent_question_version();
+
+CREATE TRIGGER cache_invalidation AFTER INSERT OR UPDATE OR DELETE ON answer
+FOR EACH ROW EXECUTE PROCEDURE notify_cache_invalidation('answer');
+
+CREATE TRIGGER cache_invalidation AFTER INSERT OR UPDATE OR DELETE ON comment
+FOR EACH ROW EXECUTE PROCEDURE notify_cache_invalidation('comment');
+
+
+-- conditional GETs of the question pages and the question lists (see http_cache.py): question.updated_at changes
+-- together with question.version, and question_list_version whenever something the lists show changes: a question
+-- added or deleted, its title, votes or submission time, or the number of its answers. Edits and comments only
+-- bump the version of their question, so the single list version row isn't written by every post
+ALTER TABLE question
+ADD COLUMN updated_at timestamp with time zone NOT NULL DEFAULT now();
+
+CREATE OR REPLACE FUNCTION bump_own_question_version() RETURNS trigger AS $$
+BEGIN
+    IF (NEW.title, NEW.message, NEW.image, NEW.vote_number, NEW.user_id, NEW.accepted_answer_id)
+        IS DISTINCT FROM (OLD.title, OLD.message, OLD.image, OLD.vote_number, OLD.user_id, OLD.accepted_answer_id) THEN
+        NEW.version := OLD.version + 1;
+    END IF;
+    -- the version is also bumped by the triggers of the answers, comments and tags of the question
+    IF NEW.version <> OLD.version THEN
+        NEW.updated_at := now();
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TABLE question_list_version (
+    version integer NOT NULL,
+    updated_at timestamp with time zone NOT NULL
+);
+
+INSERT INTO question_list_version VALUES (0, now());
+
+CREATE FUNCTION bump_question_list_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE question_list_version SET version = version + 1, updated_at = now();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER question_list_version AFTER INSERT OR DELETE ON question
+FOR EACH STATEMENT EXECUTE PROCEDURE bump_question_list_version();
+
+CREATE TRIGGER question_list_version_on_update AFTER UPDATE OF title, vote_number, submission_time ON question
+FOR EACH ROW WHEN ((OLD.title, OLD.vote_number, OLD.submission_time)
+                   IS DISTINCT FROM (NEW.title, NEW.vote_number, NEW.submission_time))
+EXECUTE PROCEDURE bump_question_list_version();
+
+-- the answer_number of the lists
+CREATE TRIGGER question_list_version AFTER INSERT OR DELETE ON answer
+FOR EACH STATEMENT EXECUTE PROCEDURE bump_question_list_version();
+
+-- the Atom feeds (see feeds.py) have their own versions, so a feed is only rebuilt when something it shows changes:
+-- 'questions' for the recent questions, 'tag:<id>' for a tag's questions and 'user:<id>' for a user's activity.
+-- A feed without a row hasn't changed since its rows were added
+CREATE TABLE feed_version (
+    feed text PRIMARY KEY,
+    version integer NOT NULL,
+    updated_at timestamp with time zone NOT NULL
+);
+
+INSERT INTO feed_version
+SELECT 'questions', 0, now()
+UNION ALL
+SELECT 'tag:' || id, 0, now() FROM tag
+UNION ALL
+SELECT 'user:' || id, 0, now() FROM user_data;
+
+CREATE FUNCTION bump_feed_versions(feeds text[]) RETURNS void AS $$
+    INSERT INTO feed_version
+    SELECT DISTINCT feed, 1, now() FROM unnest(feeds) feed WHERE feed IS NOT NULL
+    ON CONFLICT (feed) DO UPDATE SET version = feed_version.version + 1, updated_at = now();
+$$ LANGUAGE sql;
+
+-- the feeds of a post's author, and for a question the recent questions and the feeds of its tags. The entries of
+-- the answers and comments show the title of their question, so a new title changes the feeds of their authors too
+CREATE FUNCTION bump_post_feed_versions() RETURNS trigger AS $$
+DECLARE
+    post jsonb;
+    feeds text[];
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        post := to_jsonb(OLD);
+    ELSE
+        post := to_jsonb(NEW);
+    END IF;
+    feeds := ARRAY['user:' || (post ->> 'user_id')];
+    IF TG_OP = 'UPDATE' THEN
+        feeds := feeds || ('user:' || (to_jsonb(OLD) ->> 'user_id'));
+    END IF;
+    IF TG_ARGV[0] = 'question' THEN
+        feeds := feeds || 'questions'::text || ARRAY(
+            SELECT 'tag:' || tag_id FROM question_tag WHERE question_id = (post ->> 'id')::integer
+        );
+        IF TG_OP = 'UPDATE' AND NEW.title IS DISTINCT FROM OLD.title THEN
+            feeds := feeds || ARRAY(
+                SELECT 'user:' || user_id FROM answer WHERE question_id = NEW.id
+                UNION
+                SELECT 'user:' || user_id FROM comment WHERE question_id = NEW.id
+            );
+        END IF;
+    END IF;
+    PERFORM bump_feed_versions(feeds);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION bump_tag_feed_versions() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM bump_feed_versions(ARRAY['tag:' || NEW.tag_id]);
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM bump_feed_versions(ARRAY['tag:' || OLD.tag_id]);
+    ELSE
+        PERFORM bump_feed_versions(ARRAY['tag:' || OLD.tag_id, 'tag:' || NEW.tag_id]);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER feed_version AFTER INSERT OR DELETE OR UPDATE OF title, message, user_id ON question
+FOR EACH ROW EXECUTE PROCEDURE bump_post_feed_versions('question');
+
+CREATE TRIGGER feed_version AFTER INSERT OR DELETE OR UPDATE OF message, user_id ON answer
+FOR EACH ROW EXECUTE PROCEDURE bump_post_feed_versions('answer');
+
+CREATE TRIGGER feed_version AFTER INSERT OR DELETE OR UPDATE OF message, user_id ON comment
+FOR EACH ROW EXECUTE PROCEDURE bump_post_feed_versions('comment');
+
+CREATE TRIGGER feed_version AFTER INSERT OR UPDATE OR DELETE ON question_tag
+FOR EACH ROW EXECUTE PROCEDURE bump_tag_feed_versions();
+
+
+-- the hot questions of the index page: question.hot_score is the log of the question's activity (asking it, upvotes,
+-- answers and views, with the weights below), every event weighted by 2^(hours since 2020 / 24). Comparing the
+-- scores is the same as comparing the activities decayed by half every day, but the scores never have to be decayed:
+-- an event only adds to the score of its question, and the hottest questions are read from the index.
+-- Views are added in batches by refresh_hot_scores (see batch_jobs.py), so a page view stays a HOT update
+ALTER TABLE question
+ADD COLUMN hot_score double precision,
+ADD COLUMN hot_view_number integer NOT NULL DEFAULT 0;
+
+CREATE FUNCTION hot_points(weight double precision, happened_at timestamp) RETURNS double precision AS $$
+    SELECT ln(weight) + ln(2) * extract(epoch FROM happened_at - timestamp '2020-01-01') / 86400;
+$$ LANGUAGE sql IMMUTABLE;
+
+-- ln(e^score + e^points), without overflowing
+CREATE FUNCTION add_hot_points(score double precision, points double precision) RETURNS double precision AS $$
+    SELECT CASE
+        WHEN score IS NULL THEN points
+        -- exp() raises an error instead of underflowing to 0, and the smaller one doesn't count anyway
+        WHEN abs(score - points) > 40 THEN GREATEST(score, points)
+        ELSE GREATEST(score, points) + ln(1 + exp(-abs(score - points)))
+    END;
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE FUNCTION update_hot_score() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        NEW.hot_score := hot_points(1, COALESCE(NEW.submission_time, LOCALTIMESTAMP));
+    ELSIF NEW.vote_number > OLD.vote_number THEN
+        -- downvotes can't be taken from a logarithm, they only stop adding to the score
+        NEW.hot_score := add_hot_points(NEW.hot_score, hot_points(NEW.vote_number - OLD.vote_number, LOCALTIMESTAMP));
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER hot_score BEFORE INSERT OR UPDATE OF vote_number ON question
+FOR EACH ROW EXECUTE PROCEDURE update_hot_score();
+
+CREATE FUNCTION add_answer_hot_score() RETURNS trigger AS $$
+BEGIN
+    UPDATE question SET hot_score = add_hot_points(hot_score, hot_points(2, NEW.submission_time))
+    WHERE id = NEW.question_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER hot_score AFTER INSERT ON answer
+FOR EACH ROW EXECUTE PROCEDURE add_answer_hot_score();
+
+-- adds the views since the last run to the scores, and marks the question lists changed (see http_cache.py)
+CREATE FUNCTION refresh_hot_scores() RETURNS integer AS $$
+DECLARE
+    refreshed integer;
+BEGIN
+    UPDATE question
+    SET hot_score = add_hot_points(hot_score, hot_points(0.05 * (view_number - hot_view_number), LOCALTIMESTAMP)),
+        hot_view_number = view_number
+    WHERE view_number > hot_view_number;
+    GET DIAGNOSTICS refreshed = ROW_COUNT;
+    IF refreshed > 0 THEN
+        UPDATE question_list_version SET version = version + 1, updated_at = now();
+    END IF;
+    RETURN refreshed;
+END;
+$$ LANGUAGE plpgsql;
+
+-- the activity so far is counted as if it all happened when the question was asked
+UPDATE question SET
+    hot_score = hot_points(
+        1 + GREATEST(COALESCE(vote_number, 0), 0) +
+        2 * (SELECT COUNT(*) FROM answer WHERE answer.question_id = question.id) +
+        0.05 * COALESCE(view_number, 0),
+        COALESCE(submission_time, LOCALTIMESTAMP)
+    ),
+    hot_view_number = COALESCE(view_number, 0);
+
+CREATE INDEX question_hot_score ON question (hot_score DESC NULLS LAST);
+
+
+-- similar question suggestions: question.minhash is the MinHash signature of the question's text, and
+-- question_similarity_bucket holds a key for every band of it (see similarity.py). Questions sharing a key are
+-- the candidates of a lookup. Both are written by the app when a question is added or edited; the questions
+-- asked before this are indexed by `python batch_jobs.py index-similar-questions`
+ALTER TABLE question ADD COLUMN minhash bytea;
+
+CREATE TABLE question_similarity_bucket (
+    bucket bigint NOT NULL,
+    question_id integer NOT NULL REFERENCES question(id) ON DELETE CASCADE,
+    PRIMARY KEY (bucket, question_id)
+);
+
+CREATE INDEX question_similarity_bucket_question_id ON question_similarity_bucket (question_id);
+
+CREATE INDEX question_not_in_similarity_index ON question (id) WHERE minhash IS NULL;
+
+
+-- tag names are unique: the questions of a name's duplicate tags are moved to its oldest tag (the triggers keep
+-- question_count up to date), and the duplicates are deleted
+CREATE TEMPORARY TABLE tag_keeper AS
+SELECT duplicate.id AS duplicate_id, keeper.id AS keeper_id
+FROM tag duplicate
+JOIN (SELECT name, MIN(id) AS id FROM tag GROUP BY name) AS keeper
+    ON keeper.name = duplicate.name AND keeper.id <> duplicate.id;
+
+INSERT INTO question_tag (question_id, tag_id)
+SELECT DISTINCT question_tag.question_id, tag_keeper.keeper_id
+FROM question_tag
+JOIN tag_keeper ON tag_keeper.duplicate_id = question_tag.tag_id
+ON CONFLICT DO NOTHING;
+
+DELETE FROM question_tag USING tag_keeper WHERE question_tag.tag_id = tag_keeper.duplicate_id;
+
+DELETE FROM tag USING tag_keeper WHERE tag.id = tag_keeper.duplicate_id;
+
+DROP TABLE tag_keeper;
+
+DROP INDEX tag_name;
+
+CREATE UNIQUE INDEX tag_name ON tag (name);
+
+
+-- the votes cast before the vote ledger existed have no rows in it, so the reputation they earned can't be recomputed
+-- by `python batch_jobs.py recompute-reputation`. The part of every user's reputation that the ledger and the accepted
+-- answers don't explain is kept in legacy_reputation, which the job adds. It is NULL for the users there before the
+-- upgrade: the job's first run fills it in with the rules of data_manager.py, so the weights are only written there
+ALTER TABLE user_data ADD COLUMN legacy_reputation integer;
+ALTER TABLE user_data ALTER COLUMN legacy_reputation SET DEFAULT 0;
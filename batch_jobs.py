@@ -0,0 +1,73 @@
+# Maintenance jobs, run from the command line (from cron, or as a long running process with --every):
+#     python batch_jobs.py flush-votes --every 10
+#     python batch_jobs.py recompute-reputation --chunk-size 10000
+#     python batch_jobs.py refresh-hot-scores --every 300
+#     python batch_jobs.py index-similar-questions --chunk-size 1000
+#     python batch_jobs.py maintain-partitions --months-ahead 3 --archive-after 24 --archive-tablespace askmate_archive
+import argparse
+import time
+import connection
+import data_manager
+
+
+def flush_votes(options):
+    applied = data_manager.apply_pending_votes()
+    return dict(applied)
+
+
+def recompute_reputation(options):
+    return data_manager.recompute_reputations(options.chunk_size)
+
+
+def refresh_hot_scores(options):
+    return data_manager.refresh_hot_scores()
+
+
+def index_similar_questions(options):
+    return data_manager.index_unindexed_questions(options.chunk_size)
+
+
+def maintain_partitions(options):
+    return data_manager.maintain_partitions(options.months_ahead, options.archive_after, options.archive_tablespace)
+
+
+JOBS = {
+    'flush-votes': flush_votes,
+    'recompute-reputation': recompute_reputation,
+    'refresh-hot-scores': refresh_hot_scores,
+    'index-similar-questions': index_similar_questions,
+    'maintain-partitions': maintain_partitions
+}
+
+
+def run(job_name, options):
+    start = time.perf_counter()
+    report = JOBS[job_name](options)
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    print(f'{job_name}: {report}', flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a maintenance job.')
+    parser.add_argument('job', choices=JOBS)
+    parser.add_argument('--every', type=float, metavar='SECONDS', help='run the job repeatedly with this interval')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='users (recompute-reputation) or questions (index-similar-questions) per transaction')
+    parser.add_argument('--months-ahead', type=int, default=3,
+                        help='months to create the answer and comment partitions for (maintain-partitions)')
+    parser.add_argument('--archive-after', type=int, metavar='MONTHS',
+                        help='move the partitions older than this to the archive tablespace (maintain-partitions)')
+    parser.add_argument('--archive-tablespace', default='askmate_archive',
+                        help='tablespace of the archived partitions, e.g. on a compressed file system')
+    args = parser.parse_args()
+
+    # the jobs go through whole tables, the interactive statement timeout would cut them short
+    connection.set_default_query_class('reporting')
+    run(args.job, args)
+    while args.every:
+        time.sleep(args.every)
+        run(args.job, args)
+
+
+if __name__ == '__main__':
+    main()
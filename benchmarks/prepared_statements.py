@@ -0,0 +1,48 @@
+# Compares executing the prepared hot queries by name with sending the same SQL text to be parsed and planned every time.
+# Needs the usual PSQL_* environment variables, run it from the project root:
+#     python -m benchmarks.prepared_statements [repetitions] [question_id]
+import re
+import sys
+import time
+import connection
+from queries import select, update  # noqa: F401 (importing them registers their prepared statements)
+
+HOT_QUERIES = ('single_question', 'answers_for_question', 'all_comments', 'tags_for_question')
+
+
+def time_queries(cursor, execute, repetitions):
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        for name in HOT_QUERIES:
+            execute(cursor, name)
+            cursor.fetchall()
+    return time.perf_counter() - start
+
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    question_id = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    # the same statements as plain SQL text, with the $1 placeholder filled in by psycopg2
+    plain_statements = {name: re.sub(r'\$1\b', '%s', connection.PREPARED_STATEMENTS[name]) for name in HOT_QUERIES}
+
+    db_connection = connection.open_database()
+    cursor = db_connection.cursor()
+
+    plain_time = time_queries(cursor, lambda cur, name: cur.execute(plain_statements[name], (question_id,)),
+                              repetitions)
+    prepared_time = time_queries(cursor, lambda cur, name: connection.execute_prepared(cur, name, (question_id,)),
+                                 repetitions)
+
+    cursor.close()
+    db_connection.close()
+
+    executions = repetitions * len(HOT_QUERIES)
+    print(f'{executions} executions of {", ".join(HOT_QUERIES)}')
+    print(f'plain:    {plain_time:.3f} s ({plain_time / executions * 1e6:.1f} us per query)')
+    print(f'prepared: {prepared_time:.3f} s ({prepared_time / executions * 1e6:.1f} us per query)')
+    print(f'saved:    {(plain_time - prepared_time) / executions * 1e6:.1f} us per query')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+# Small in-process caches shared by the templates and the data layer.
+# Every worker keeps its own copy, so anything stored here has to be either versioned or short lived.
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Size-bounded least-recently-used cache with an optional time-to-live for every entry.
+    Safe to share between the threads of one worker.
+    :param on_evict: called with the key of every entry dropped for the size bound, while the cache's lock is held
+    """
+
+    def __init__(self, max_size, ttl=None, on_evict=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                evicted_key, _ = self._entries.popitem(last=False)
+                if self.on_evict is not None:
+                    self.on_evict(evicted_key)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+class VersionedCache:
+    """
+    LRUCache for database rows where every key carries a version number. Invalidating a key bumps its version,
+    so a row that was being loaded while it got invalidated is never served afterwards.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.entries = LRUCache(max_size, ttl)
+        self.hits = 0
+        self.misses = 0
+        # Versions have to outlive the entries they protect, but they must stay bounded as well. Every invalidation
+        # takes a new number, and a key whose version was evicted is at the floor: the last number taken before the
+        # eviction. So a row loaded before it got invalidated doesn't become current again when its version is evicted.
+        self._last_version = 0
+        self._version_floor = 0
+        self._lock = threading.Lock()
+        self._versions = LRUCache(max_size * 10, on_evict=self._version_evicted)
+
+    def get_or_load(self, key, load):
+        version = self._versions.get(key, self._version_floor)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        value = load()
+        if value is not None:
+            self.entries.set(key, (version, value))
+        return value
+
+    def update(self, key, changes):
+        """Changes some fields of a cached row in place, without invalidating it."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[1].update(changes)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._last_version += 1
+            self._versions.set(key, self._last_version)
+        self.entries.delete(key)
+
+    def _version_evicted(self, key):
+        self._version_floor = self._last_version
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.entries.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+class SegmentedLRUCache:
+    """
+    Size-bounded cache evicting by both recency and frequency (segmented LRU). New entries go to a probation segment,
+    and an entry found there again moves to the protected segment, which takes up protected_share of the cache.
+    The least recently used entries of probation are evicted first, so entries used once (e.g. a rare search) make
+    room before the ones used repeatedly, however recently the rare ones were added.
+    :param on_evict: called with the key of every entry removed from the cache, except by clear()
+    :param max_weight: if given, entries are also evicted while the sum of weigh(value) of all entries is larger,
+        e.g. to bound the cache by the size of the values instead of their number
+    """
+
+    def __init__(self, max_size, ttl=None, protected_share=0.8, on_evict=None, max_weight=None, weigh=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.protected_size = int(max_size * protected_share)
+        self.on_evict = on_evict
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> (value, expires_at)
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        # key -> weigh(value), only with max_weight
+        self._weights = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            segment = self._protected if key in self._protected else self._probation
+            entry = segment.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._promote(key, segment)
+                    self.hits += 1
+                    return value
+                del segment[key]
+                self._unweigh(key)
+                self._evicted(key)
+            self.misses += 1
+            return default
+
+    def _promote(self, key, segment):
+        if segment is self._protected:
+            self._protected.move_to_end(key)
+            return
+        self._protected[key] = self._probation.pop(key)
+        # the least recently used protected entry gets another chance in probation
+        while len(self._protected) > self.protected_size:
+            demoted_key, demoted_entry = self._protected.popitem(last=False)
+            self._probation[demoted_key] = demoted_entry
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if self.max_weight is not None:
+                self._unweigh(key)
+                self._weights[key] = self.weigh(value)
+                self.weight += self._weights[key]
+            if key in self._protected:
+                self._protected[key] = (value, expires_at)
+                self._protected.move_to_end(key)
+            else:
+                self._probation[key] = (value, expires_at)
+                self._probation.move_to_end(key)
+            while len(self._probation) + len(self._protected) > self.max_size or self._overweight():
+                segment = self._probation if self._probation else self._protected
+                evicted_key, _ = segment.popitem(last=False)
+                self._unweigh(evicted_key)
+                self._evicted(evicted_key)
+
+    def delete(self, key):
+        with self._lock:
+            if self._probation.pop(key, None) is not None or self._protected.pop(key, None) is not None:
+                self._unweigh(key)
+                self._evicted(key)
+
+    def _overweight(self):
+        return self.max_weight is not None and self.weight > self.max_weight
+
+    def _unweigh(self, key):
+        self.weight -= self._weights.pop(key, 0)
+
+    def _evicted(self, key):
+        if self.on_evict is not None:
+            self.on_evict(key)
+
+    def keys(self):
+        with self._lock:
+            return list(self._probation) + list(self._protected)
+
+    def clear(self):
+        with self._lock:
+            self._probation.clear()
+            self._protected.clear()
+            self._weights.clear()
+            self.weight = 0
+
+    def __len__(self):
+        return len(self._probation) + len(self._protected)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        stats = {
+            'size': len(self),
+            'protected': len(self._protected),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+        if self.max_weight is not None:
+            stats.update({'weight': self.weight, 'max_weight': self.max_weight})
+        return stats
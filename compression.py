@@ -0,0 +1,184 @@
+# WSGI middleware compressing the responses with gzip, or brotli when the brotli package is installed and the client
+# accepts it. Only successful responses of text-like content types over a minimum size are compressed, and bodies
+# are compressed chunk by chunk as the app produces them, so large and streamed pages are never buffered whole.
+# The compressed variants of responses with a strong ETag (e.g. the static files) are kept in memory,
+# so they are compressed once instead of on every request.
+import os
+import zlib
+from cache import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MINIMUM_SIZE = int(os.environ.get('ASKMATE_COMPRESS_MIN_SIZE', 500))
+GZIP_LEVEL = int(os.environ.get('ASKMATE_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('ASKMATE_BROTLI_QUALITY', 5))
+COMPRESSIBLE_TYPES = (
+    'text/html', 'text/css', 'text/plain', 'text/xml', 'text/javascript',
+    'application/javascript', 'application/json', 'application/xml', 'application/atom+xml', 'image/svg+xml'
+)
+
+# (path, ETag, encoding) -> compressed body, only for bodies up to VARIANT_MAX_SIZE
+VARIANT_CACHE_SIZE = int(os.environ.get('ASKMATE_COMPRESSED_VARIANT_CACHE_SIZE', 500))
+VARIANT_MAX_SIZE = 1024 * 1024
+compressed_variants = LRUCache(VARIANT_CACHE_SIZE)
+
+
+class GzipCompressor:
+    def __init__(self):
+        # wbits 16 + MAX_WBITS writes the gzip header and trailer
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        # every chunk is flushed, so the client can show a streamed page while it arrives
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+COMPRESSORS = {'gzip': GzipCompressor}
+if brotli is not None:
+    COMPRESSORS['br'] = BrotliCompressor
+
+
+def compress(data, encoding):
+    """Compresses a whole body, e.g. for a response cache storing its entries compressed."""
+    compressor = COMPRESSORS[encoding]()
+    return compressor.compress(data) + compressor.finish()
+
+
+def accepted_encoding(accept_encoding):
+    """
+    :param accept_encoding: value of the Accept-Encoding request header
+    :return: the best supported encoding the client accepts (brotli compresses better), or None
+    """
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, parameters = part.strip().partition(';')
+        quality = 1.0
+        if parameters.strip().startswith('q='):
+            try:
+                quality = float(parameters.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+
+    for encoding in ('br', 'gzip'):
+        if encoding in COMPRESSORS and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def is_compressible(status, headers):
+    if not status.startswith('200'):
+        return False
+    header_names = {name.lower(): value for name, value in headers}
+    content_type = header_names.get('content-type', '').split(';')[0].strip().lower()
+    if content_type not in COMPRESSIBLE_TYPES or 'content-encoding' in header_names:
+        return False
+    if 'no-transform' in header_names.get('cache-control', ''):
+        return False
+    # a streamed body has no length, and is expected to be large
+    content_length = header_names.get('content-length')
+    return content_length is None or int(content_length) >= MINIMUM_SIZE
+
+
+def compressed_headers(headers, encoding, content_length=None):
+    headers = [(name, value) for name, value in headers if name.lower() != 'content-length']
+    vary = [value for name, value in headers if name.lower() == 'vary']
+    headers = [(name, value) for name, value in headers if name.lower() != 'vary']
+    headers.append(('Vary', ', '.join(vary + ['Accept-Encoding'])))
+    headers.append(('Content-Encoding', encoding))
+    if content_length is not None:
+        headers.append(('Content-Length', str(content_length)))
+    # the compressed body is a different representation: a strong ETag must not be shared with the uncompressed one
+    return [(name, weak_etag(value) if name.lower() == 'etag' else value) for name, value in headers]
+
+
+def weak_etag(etag):
+    return etag if etag.startswith('W/') else f'W/{etag}'
+
+
+class CompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        encoding = accepted_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.app(environ, start_response)
+
+        response = {}
+
+        def compressing_start_response(status, headers, exc_info=None):
+            response['status'], response['headers'] = status, headers
+            response['compress'] = is_compressible(status, headers)
+            if not response['compress']:
+                return start_response(status, headers, exc_info)
+            response['compressor'] = COMPRESSORS[encoding]()
+            response['etag'] = next((value for name, value in headers if name.lower() == 'etag'), None)
+            response['length'] = next((int(value) for name, value in headers if name.lower() == 'content-length'),
+                                      None)
+            if self.cached_variant_key(environ, response, encoding) is not None:
+                # sent once the body is known, it may already be compressed
+                response['exc_info'] = exc_info
+                return response.setdefault('buffer', []).append
+            write = start_response(status, compressed_headers(headers, encoding), exc_info)
+            return lambda data: write(response['compressor'].compress(data))
+
+        app_iter = self.app(environ, compressing_start_response)
+        if not response.get('compress'):
+            return app_iter
+        if 'buffer' in response:
+            return self.cached_variant(environ, start_response, app_iter, response, encoding)
+        return self.compressed(app_iter, response['compressor'])
+
+    @staticmethod
+    def cached_variant_key(environ, response, encoding):
+        etag = response['etag']
+        if etag is None or etag.startswith('W/') or response['length'] is None or response['length'] > VARIANT_MAX_SIZE:
+            return None
+        return environ.get('PATH_INFO'), environ.get('QUERY_STRING'), etag, encoding
+
+    def cached_variant(self, environ, start_response, app_iter, response, encoding):
+        key = self.cached_variant_key(environ, response, encoding)
+        body = compressed_variants.get(key)
+        try:
+            if body is None:
+                body = compress(b''.join(response['buffer'] + list(app_iter)), encoding)
+                compressed_variants.set(key, body)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        start_response(response['status'], compressed_headers(response['headers'], encoding, len(body)),
+                       response['exc_info'])
+        return [body]
+
+    @staticmethod
+    def compressed(app_iter, compressor):
+        try:
+            for chunk in app_iter:
+                if chunk:
+                    yield compressor.compress(chunk)
+            yield compressor.finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+def init_app(app):
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app)
@@ -1,8 +1,157 @@
 # Creates a decorator to handle the database connection/cursor opening/closing.
 # Creates the cursor with RealDictCursor, thus it returns real dictionaries, where the column names are the keys.
+# Connections are taken from a per-process pool and are given back to it after the decorated function returns.
+# Connecting, every statement and waiting for a pooled connection have time limits, and a circuit breaker refuses
+# the database calls for a while after repeated failures, so a slow or unreachable database can't hang the workers.
+import contextlib
 import os
+import threading
+import time
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
+
+POOL_MIN_SIZE = int(os.environ.get('ASKMATE_DB_POOL_MIN_SIZE', 2))
+POOL_MAX_SIZE = int(os.environ.get('ASKMATE_DB_POOL_MAX_SIZE', 10))
+# rows a server-side cursor fetches per round trip, see streaming_handler()
+STREAM_FETCH_SIZE = int(os.environ.get('ASKMATE_DB_STREAM_FETCH_SIZE', 200))
+
+CONNECT_TIMEOUT = int(os.environ.get('ASKMATE_DB_CONNECT_TIMEOUT', 5))
+# longest wait for a free pooled connection before the request is given up
+POOL_WAIT_TIMEOUT = float(os.environ.get('ASKMATE_DB_POOL_WAIT_TIMEOUT_MS', 2000)) / 1000
+# statement_timeout of the query classes (in milliseconds): the pages' queries are interactive, the users summary and
+# the batch jobs are reporting queries, see connection_handler() and set_default_query_class()
+STATEMENT_TIMEOUTS = {
+    'interactive': int(os.environ.get('ASKMATE_DB_STATEMENT_TIMEOUT_MS', 5000)),
+    'reporting': int(os.environ.get('ASKMATE_DB_REPORTING_STATEMENT_TIMEOUT_MS', 120000))
+}
+# a transaction left open this long (e.g. a streamed page the client stopped reading) is ended by the server
+IDLE_IN_TRANSACTION_TIMEOUT = int(os.environ.get('ASKMATE_DB_IDLE_IN_TRANSACTION_TIMEOUT_MS', 30000))
+_default_query_class = {'name': 'interactive'}
+
+# consecutive failed database calls opening the circuit, and seconds it stays open, see CircuitBreaker
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('ASKMATE_DB_CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get('ASKMATE_DB_CIRCUIT_RESET_TIMEOUT', 10))
+
+# name -> statement text with $1, $2... placeholders, see prepared_statement()
+PREPARED_STATEMENTS = {}
+
+# database round trips made by this process: connections taken from the pool, and executed queries
+# (a call to execute() counts as one query, even if it sends several statements), see query_counts.py
+statistics = {'connections': 0, 'queries': 0}
+
+# average of the seconds get_connection() waited for a free connection, weighting the recent waits the most.
+# It decays with this half-life while no connection is taken, see average_pool_wait()
+POOL_WAIT_HALF_LIFE = 10
+POOL_WAIT_SMOOTHING = 0.1
+_pool_wait = {'average': 0.0, 'updated_at': time.monotonic()}
+
+_pool = None
+_pool_lock = threading.Lock()
+# the pool raises an error instead of waiting when all of its connections are taken, so the threads wait here
+_pool_slots = threading.BoundedSemaphore(POOL_MAX_SIZE)
+
+
+class DatabaseUnavailable(Exception):
+    """
+    The database didn't answer in time, couldn't be reached, or the circuit breaker is open.
+    :ivar retry_after: seconds after which trying again makes sense
+    """
+
+    def __init__(self, message, retry_after=CIRCUIT_RESET_TIMEOUT):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Fails fast while the database looks unhealthy. After failure_threshold failed calls in a row (connection errors,
+    timeouts) the circuit opens, and every call is refused with DatabaseUnavailable for reset_timeout seconds.
+    Then a single trial call is let through: the circuit closes if it succeeds, and opens again if it fails.
+    A call that never reached the database (e.g. no pooled connection got free) doesn't count either way,
+    and neither does a statement running into its timeout: that is a slow query, not an unhealthy database.
+    Every worker has its own breaker, like its own pool.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = None
+        self._lock = threading.Lock()
+
+    @property
+    def trial_running(self):
+        return self._trial is not None
+
+    def before_call(self):
+        """
+        :return: the trial token if this call is the trial call, None otherwise;
+            to be passed to record() or cancel() when the call ends
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return None
+            remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+            if remaining > 0 or self._trial is not None:
+                raise DatabaseUnavailable('The database circuit is open', max(1, round(remaining)))
+            self._trial = object()
+            return self._trial
+
+    def _end_trial(self, trial):
+        # a call that started before the trial doesn't end it
+        if trial is not None and trial is self._trial:
+            self._trial = None
+
+    def record(self, failed, trial=None):
+        with self._lock:
+            self._end_trial(trial)
+            if not failed:
+                self.failures = 0
+                self.opened_at = None
+                self._trial = None
+                return
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    def cancel(self, trial=None):
+        """Ends a call that says nothing about the database's health, so another trial call can be let through."""
+        with self._lock:
+            self._end_trial(trial)
+
+    def stats(self):
+        state = 'closed' if self.opened_at is None else 'half-open' if self.trial_running else 'open'
+        return {'state': state, 'failures': self.failures}
+
+
+breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # names of the statements already prepared in this connection's session
+        self.prepared_statements = set()
+        # the circuit breaker's trial token of the call holding the connection, see get_connection()
+        self.breaker_trial = None
+
+
+class CountingCursorMixin:
+    def execute(self, query, vars=None):
+        statistics['queries'] += 1
+        return super().execute(query, vars)
+
+
+class DictCursor(CountingCursorMixin, psycopg2.extras.RealDictCursor):
+    pass
+
+
+class RecordCursor(CountingCursorMixin, psycopg2.extras.NamedTupleCursor):
+    pass
 
 
 def get_connection_string():
@@ -20,10 +169,24 @@ def get_connection_string():
         raise KeyError('Some necessary environment variable(s) are not defined')
 
 
+def set_default_query_class(query_class):
+    """Sets the query class of the connections opened from now on, e.g. 'reporting' for the batch jobs."""
+    _default_query_class['name'] = query_class
+
+
+def connection_options():
+    """psycopg2.connect() keyword arguments limiting the time spent connecting and in every statement."""
+    return {
+        'connect_timeout': CONNECT_TIMEOUT,
+        'options': f"-c statement_timeout={STATEMENT_TIMEOUTS[_default_query_class['name']]} "
+                   f"-c idle_in_transaction_session_timeout={IDLE_IN_TRANSACTION_TIMEOUT}"
+    }
+
+
 def open_database():
     try:
         connection_string = get_connection_string()
-        connection = psycopg2.connect(connection_string)
+        connection = psycopg2.connect(connection_string, connection_factory=PooledConnection, **connection_options())
         connection.autocommit = True
     except psycopg2.DatabaseError as exception:
         print('Database connection problem')
@@ -31,14 +194,235 @@ def open_database():
     return connection
 
 
-def connection_handler(function):
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            try:
+                _pool = psycopg2.pool.ThreadedConnectionPool(POOL_MIN_SIZE, POOL_MAX_SIZE, get_connection_string(),
+                                                             connection_factory=PooledConnection,
+                                                             **connection_options())
+            except psycopg2.DatabaseError as exception:
+                print('Database connection problem')
+                raise exception
+    return _pool
+
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.closeall()
+        _pool = None
+
+
+def prime_pool():
+    """
+    Opens the pool's idle connections and prepares every registered statement on them,
+    so the first requests of a new worker don't have to.
+    """
+    connections = []
+    try:
+        for _ in range(POOL_MIN_SIZE):
+            connections.append(get_connection())
+        for connection in connections:
+            with connection.cursor(cursor_factory=DictCursor) as cursor:
+                for name in PREPARED_STATEMENTS:
+                    if name not in connection.prepared_statements:
+                        prepare(cursor, name)
+    finally:
+        for connection in connections:
+            release_connection(connection)
+            breaker.cancel(connection.breaker_trial)
+
+
+def get_connection():
+    """
+    :raise DatabaseUnavailable: if the circuit is open, no pooled connection got free within POOL_WAIT_TIMEOUT,
+        or a new connection couldn't be opened
+    """
+    trial = breaker.before_call()
+    statistics['connections'] += 1
+    start = time.monotonic()
+    acquired = _pool_slots.acquire(timeout=POOL_WAIT_TIMEOUT)
+    record_pool_wait(time.monotonic() - start)
+    if not acquired:
+        # the worker is overloaded, not the database: shed the request without opening the circuit
+        breaker.cancel(trial)
+        raise DatabaseUnavailable('No database connection got free in time', retry_after=1)
+    try:
+        connection = get_pool().getconn()
+    except psycopg2.OperationalError as exception:
+        _pool_slots.release()
+        breaker.record(failed=True, trial=trial)
+        raise DatabaseUnavailable(str(exception)) from exception
+    except BaseException:
+        _pool_slots.release()
+        breaker.cancel(trial)
+        raise
+    connection.autocommit = True
+    connection.breaker_trial = trial
+    return connection
+
+
+def release_connection(connection):
+    try:
+        get_pool().putconn(connection, close=bool(connection.closed))
+    finally:
+        _pool_slots.release()
+
+
+@contextlib.contextmanager
+def database_call():
+    """
+    Takes a pooled connection for one call of the decorated functions, and tells the circuit breaker how it went.
+    Connection errors and timeouts (OperationalError) are raised as DatabaseUnavailable.
+    """
+    connection = get_connection()
+    trial = connection.breaker_trial
+    failed = False
+    timed_out = False
+    try:
+        yield connection
+    except psycopg2.errors.QueryCanceledError as exception:
+        timed_out = True
+        raise DatabaseUnavailable(str(exception)) from exception
+    except psycopg2.OperationalError as exception:
+        failed = True
+        raise DatabaseUnavailable(str(exception)) from exception
+    finally:
+        try:
+            release_connection(connection)
+        finally:
+            if timed_out:
+                breaker.cancel(trial)
+            else:
+                breaker.record(failed, trial)
+
+
+def set_local_statement_timeout(cursor, query_class):
+    """Sets the statement_timeout of the query class for the rest of the cursor's transaction."""
+    cursor.execute('SET LOCAL statement_timeout = %s', (STATEMENT_TIMEOUTS[query_class],))
+
+
+def record_pool_wait(seconds):
+    _pool_wait['average'] = average_pool_wait() * (1 - POOL_WAIT_SMOOTHING) + seconds * POOL_WAIT_SMOOTHING
+    _pool_wait['updated_at'] = time.monotonic()
+
+
+def average_pool_wait():
+    elapsed = time.monotonic() - _pool_wait['updated_at']
+    return _pool_wait['average'] * 0.5 ** (elapsed / POOL_WAIT_HALF_LIFE)
+
+
+def prepared_statement(name, statement):
+    """
+    Registers a statement to be prepared on the server once per pooled connection, and executed by name after that.
+    :param name: name of the prepared statement, must be a valid SQL identifier
+    :param statement: SQL text using $1, $2... as placeholders
+    :return: the name, to be passed to execute_prepared()
+    """
+    PREPARED_STATEMENTS[name] = statement
+    return name
+
+
+def execute_prepared(cursor, name, params=()):
+    """
+    Executes a statement registered with prepared_statement() on the cursor, preparing it first if this connection
+    hasn't done so yet. If the server doesn't know the statement anymore (the session was reset or recycled)
+    it is prepared again, and so is a statement whose result columns changed since (a migration altered a table).
+    The registered statements list their columns anyway, so that a new column doesn't change them.
+    Only meant for autocommit connections, the failed EXECUTE would abort a transaction.
+    """
+    connection = cursor.connection
+    if name not in connection.prepared_statements:
+        prepare(cursor, name)
+
+    placeholders = ', '.join(['%s'] * len(params))
+    execute_statement = f'EXECUTE {name} ({placeholders})' if params else f'EXECUTE {name}'
+    try:
+        cursor.execute(execute_statement, params)
+    except psycopg2.errors.InvalidSqlStatementName:
+        prepare(cursor, name)
+        cursor.execute(execute_statement, params)
+    except psycopg2.errors.FeatureNotSupported:
+        # "cached plan must not change result type"
+        cursor.execute(f'DEALLOCATE {name}')
+        prepare(cursor, name)
+        cursor.execute(execute_statement, params)
+
+
+def prepare(cursor, name):
+    connection = cursor.connection
+    connection.prepared_statements.discard(name)
+    try:
+        cursor.execute(f'PREPARE {name} AS {PREPARED_STATEMENTS[name]}')
+    except psycopg2.errors.DuplicatePreparedStatement:
+        pass
+    connection.prepared_statements.add(name)
+
+
+def connection_handler(function=None, *, compact_rows=False, query_class=None):
+    """
+    Can be used as @connection_handler or as @connection_handler(compact_rows=True).
+    With compact_rows the cursor returns named tuples instead of dictionaries: the column names are stored once
+    per query instead of once per row, and the fields are still accessible as attributes (e.g. in the templates),
+    but the rows are immutable. Meant for queries returning many rows.
+    With a query_class (e.g. 'reporting') the queries run in a transaction with that class' statement_timeout
+    instead of the connection's one.
+    """
+    # we set the cursor_factory parameter to return with a RealDictCursor cursor (cursor which provide dictionaries)
+    cursor_factory = RecordCursor if compact_rows else DictCursor
+
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            with database_call() as connection:
+                if query_class is None:
+                    cursor = connection.cursor(cursor_factory=cursor_factory)
+                    ret_value = function(cursor, *args, **kwargs)
+                    cursor.close()
+                    return ret_value
+
+                connection.autocommit = False
+                with connection, connection.cursor(cursor_factory=cursor_factory) as cursor:
+                    set_local_statement_timeout(cursor, query_class)
+                    return function(cursor, *args, **kwargs)
+
+        return wrapper
+
+    if function is None:
+        return decorator
+    return decorator(function)
+
+
+def transaction_handler(function):
+    """
+    Same as connection_handler, but everything the decorated function executes runs in a single transaction,
+    which is committed when the function returns and rolled back if it raises.
+    """
     def wrapper(*args, **kwargs):
-        connection = open_database()
-        # we set the cursor_factory parameter to return with a RealDictCursor cursor (cursor which provide dictionaries)
-        dict_cur = connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        ret_value = function(dict_cur, *args, **kwargs)
-        dict_cur.close()
-        connection.close()
+        with database_call() as connection:
+            connection.autocommit = False
+            # the connection's context manager commits or rolls back, the cursor's one closes the cursor
+            with connection, connection.cursor(cursor_factory=DictCursor) as dict_cur:
+                ret_value = function(dict_cur, *args, **kwargs)
         return ret_value
 
     return wrapper
+
+
+def streaming_handler(function):
+    """
+    For generator functions yielding the rows of large results: the decorated function gets a server-side (named)
+    cursor, iterating over it fetches STREAM_FETCH_SIZE rows per round trip instead of the whole result at once.
+    The connection is taken when the iteration starts, and is given back when it ends or the generator is closed
+    (e.g. when the client of a streamed response goes away). A server-side cursor only lives as long as its
+    transaction, so the query runs in one, which is never left open after the generator.
+    """
+    def wrapper(*args, **kwargs):
+        with database_call() as connection:
+            connection.autocommit = False
+            with connection, connection.cursor(f'stream_{function.__name__}', cursor_factory=DictCursor) as cursor:
+                cursor.itersize = STREAM_FETCH_SIZE
+                yield from function(cursor, *args, **kwargs)
+
+    return wrapper
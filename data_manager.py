@@ -1,6 +1,42 @@
+import connection
+import itertools
+import os
 import util
+import similarity
+import tag_index
+from cache import VersionedCache
+from search_cache import SearchCache, SearchResult, AnswerResult
 from queries import select, insert, update, delete
 
+ENTITY_CACHE_SIZE = int(os.environ.get('ASKMATE_ENTITY_CACHE_SIZE', 1000))
+ENTITY_CACHE_TTL = int(os.environ.get('ASKMATE_ENTITY_CACHE_TTL', 60))
+
+# single rows by (table, id), the write functions below invalidate the rows they change.
+# 'question_page' holds the question as shown on its page (with the author's name and reputation)
+entity_cache = VersionedCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+
+SEARCH_CACHE_SIZE = int(os.environ.get('ASKMATE_SEARCH_CACHE_SIZE', 1000))
+SEARCH_CACHE_TTL = int(os.environ.get('ASKMATE_SEARCH_CACHE_TTL', 60))
+SEARCH_CACHE_MAX_RESULTS = int(os.environ.get('ASKMATE_SEARCH_CACHE_MAX_RESULTS', 200))
+# characters of the cached questions and answers, summed over all phrases
+SEARCH_CACHE_MAX_CHARS = int(os.environ.get('ASKMATE_SEARCH_CACHE_MAX_CHARS', 20_000_000))
+
+# search results by normalized phrase, see search_cache.py
+search_cache = SearchCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_CHARS)
+
+# reputation the author of a message gets for an upvote (1) or a downvote (-1) on it, and for an accepted answer
+REPUTATION_FOR_VOTES = {
+    'question': {1: 5, -1: -2},
+    'answer': {1: 10, -1: -2}
+}
+REPUTATION_FOR_ACCEPTED_ANSWER = 15
+
+# similar question suggestions, see similarity.py: questions read per shared bucket key, candidates compared
+# by their signatures, and the smallest estimated similarity shown
+SIMILAR_QUESTIONS_PER_BUCKET = 100
+SIMILAR_QUESTION_CANDIDATES = 50
+MIN_SIMILARITY = float(os.environ.get('ASKMATE_MIN_SIMILARITY', 0.2))
+
 # ------------------------------------------------------------------
 # ------------------------------SELECT------------------------------
 # ------------------------------------------------------------------
@@ -12,8 +48,10 @@ def get_all_questions(order_by, order):
 
 
 def get_single_question(question_id):
-    question = select.single_question(question_id, )
-    return question
+    question = entity_cache.get_or_load(('question_page', str(question_id)),
+                                        lambda: select.single_question(question_id))
+    # callers get their own copy, so changing it doesn't change the cached row
+    return dict(question) if question else question
 
 
 def get_most_recent_questions(number_of_entries=5):
@@ -21,6 +59,52 @@ def get_most_recent_questions(number_of_entries=5):
     return questions
 
 
+def get_question_list_version():
+    list_version = select.question_list_version()
+    return list_version
+
+
+def get_feed_version(feed):
+    """:param feed: name of the feed's version, e.g. 'tag:3' (see feeds.py)"""
+    version = select.feed_version(feed)
+    return version
+
+
+def get_hot_questions(number_of_entries=10):
+    questions = select.hot_questions(number_of_entries)
+    return questions
+
+
+def get_similar_questions(title, message, number_of_entries=5, question_id=None, signature=None):
+    """
+    :param question_id: the question the suggestions are for, left out of them
+    :param signature: the question's MinHash signature if it is known, computed from the title and message otherwise
+    :return: at most number_of_entries {'id', 'title', 'similarity'} dictionaries, the most similar questions first
+    """
+    signature = signature or similarity.signature(title, message)
+    if signature is None:
+        return []
+
+    candidates = select.similar_question_candidates(similarity.buckets(signature), SIMILAR_QUESTIONS_PER_BUCKET,
+                                                    SIMILAR_QUESTION_CANDIDATES)
+    similar_questions = []
+    for candidate in candidates:
+        if str(candidate.id) == str(question_id) or not candidate.minhash:
+            continue
+        estimate = similarity.estimated_similarity(signature, similarity.unpack(candidate.minhash))
+        if estimate >= MIN_SIMILARITY:
+            similar_questions.append({'id': candidate.id, 'title': candidate.title, 'similarity': estimate})
+
+    similar_questions.sort(key=lambda question: question['similarity'], reverse=True)
+    return similar_questions[:number_of_entries]
+
+
+def get_questions_similar_to(question, number_of_entries=5):
+    """:param question: a row of get_single_question()"""
+    signature = similarity.unpack(question['minhash']) if question.get('minhash') else None
+    return get_similar_questions(question['title'], question['message'], number_of_entries, question['id'], signature)
+
+
 def get_answers_for_question(question_id):
     answers = select.answers_for_question(question_id)
     return answers
@@ -31,19 +115,14 @@ def get_all_comments(comment_id):
     return comment_data
 
 
-def get_latest_id(table):
-    latest_id = select.latest_id(table)
-    return latest_id
-
-
 def get_question_ids():
     question_ids = select.all_question_ids()
     return question_ids
 
 
 def get_single_entry(table, entry_id):
-    entry = select.single_entry(table, entry_id)
-    return entry
+    entry = entity_cache.get_or_load((table, str(entry_id)), lambda: select.single_entry(table, entry_id))
+    return dict(entry) if entry else entry
 
 
 def get_tags_for_question(question_id):
@@ -51,9 +130,9 @@ def get_tags_for_question(question_id):
     return tags
 
 
-def get_existing_tags_for_question(question_id):
-    existing_tags = select.existing_tags_for_question(question_id)
-    return existing_tags
+def get_tag_suggestions(prefix):
+    tags = tag_index.search(prefix)
+    return tags
 
 
 def get_tags_counted():
@@ -61,6 +140,34 @@ def get_tags_counted():
     return tags_counted
 
 
+def get_tag_by_name(tag_name):
+    tag = select.tag_by_name(tag_name)
+    return tag
+
+
+def get_questions_for_tag(tag_id, before_question_id=None, number_of_entries=20):
+    questions = select.questions_for_tag(tag_id, before_question_id, number_of_entries)
+    return questions
+
+
+def get_recent_question_feed_entries(number_of_entries, summary_length):
+    entries = select.recent_question_feed_entries(number_of_entries, summary_length)
+    return entries
+
+
+def get_tag_question_feed_entries(tag_id, number_of_entries, summary_length):
+    entries = select.tag_question_feed_entries(tag_id, number_of_entries, summary_length)
+    return entries
+
+
+def get_user_activity_feed(user_id, number_of_entries, summary_length):
+    """:return: {'username', 'entries'} of the user's feed, None if there is no such user"""
+    rows = select.user_activity_feed_entries(user_id, number_of_entries, summary_length)
+    if not rows:
+        return None
+    return {'username': rows[0].username, 'entries': [row for row in rows if row.kind is not None]}
+
+
 def get_hashed_password_for(username):
     hashed_password = select.hashed_password_for(username)
     if hashed_password:
@@ -126,6 +233,17 @@ def get_user_stats():
     user_stats = select.user_stats()
     return user_stats
 
+
+def get_cache_stats():
+    return {'entities': entity_cache.stats(), 'searches': search_cache.stats()}
+
+
+def invalidate_entry(table, entry_id):
+    entity_cache.invalidate((table, str(entry_id)))
+    if table == 'question':
+        entity_cache.invalidate(('question_page', str(entry_id)))
+        search_cache.invalidate_question(entry_id)
+
 # ------------------------------------------------------------------
 # ------------------------------INSERT------------------------------
 # ------------------------------------------------------------------
@@ -134,12 +252,18 @@ def get_user_stats():
 def insert_question(question_data, user_id):
     question_data['user_id'] = user_id
     question_data = util.amend_user_inputs_for_question(question_data)
-    insert.question(question_data)
+    question_data.update(similarity_index_entry(question_data.get('title'), question_data.get('message')))
+    question_id = insert.question(question_data)
+    search_cache.invalidate_text(question_data.get('title'), question_data.get('message'))
+    return question_id
 
 
 def insert_answer(user_inputs, question_id, user_id):
     new_answer_data = util.amend_user_inputs_for_answer(question_id, user_inputs, user_id)
-    insert.answer(new_answer_data)
+    answer_id = insert.answer(new_answer_data)
+    invalidate_entry('question', question_id)
+    search_cache.invalidate_text(new_answer_data['new_answer'])
+    return answer_id
 
 
 def insert_comment(message, question_id, user_id, answer_id=None):
@@ -150,31 +274,33 @@ def insert_comment(message, question_id, user_id, answer_id=None):
         'user_id': user_id
     }
     new_comment_data = util.amend_user_inputs_for_comment(new_comment_data)
-    insert.comment(new_comment_data)
+    comment_id = insert.comment(new_comment_data)
+    invalidate_entry('question', question_id)
+    return comment_id
 
 
 def handle_new_tag(question_id, new_tag):
-    if util.is_duplicate_tag(new_tag):
+    existing_tag = select.tag_by_name(new_tag)
+    if existing_tag:
         if not util.tag_belongs_to_question(question_id, new_tag):
-            tag_id = select.tag_id(new_tag)
-            insert_existing_tag(question_id, tag_id)
-        else:
-            return
+            insert_existing_tag(question_id, existing_tag['id'])
     else:
-        insert.tag_into_tag_table(new_tag)
-        tag_id = select.tag_id(new_tag)
+        tag_id = insert.tag_into_tag_table(new_tag)
         insert_existing_tag(question_id, tag_id)
 
 
 def insert_existing_tag(question_id, tag_id):
     insert.tag_into_question_table(question_id, tag_id)
+    invalidate_entry('question', question_id)
+    tag_index.refresh_tag(tag_id)
 
 
 def insert_user(user_data_orig):
     user_data = dict(user_data_orig)
     user_data['password'] = util.get_hashed_password(user_data['password'])
     user_data.update({'reg_date': util.get_datetime()})
-    insert.new_user(user_data)
+    user_id = insert.new_user(user_data)
+    return user_id
 
 
 # ------------------------------------------------------------------
@@ -184,39 +310,124 @@ def insert_user(user_data_orig):
 
 def update_entry(table, entry_id, entry_updater):
     entry_updater.update({'id': entry_id})
-    update.entry(table, entry_updater)
+    updated_entry = update.entry(table, entry_updater)
+    invalidate_entry(table, entry_id)
+    if updated_entry and table == 'question':
+        index_similar_questions([updated_entry])
+    if updated_entry and table in ('question', 'answer'):
+        search_cache.invalidate_text(updated_entry.get('title'), updated_entry.get('message'))
+    if updated_entry and table != 'question':
+        invalidate_entry('question', updated_entry['question_id'])
 
 
 def update_comment_message(comment_data, new_comment_message):
     updated_comment = util.handle_updated_comment(comment_data, new_comment_message)
     update.entry('comment', updated_comment)
+    invalidate_entry('comment', updated_comment['id'])
+    invalidate_entry('question', updated_comment['question_id'])
 
 
 def increment_view_number(question_id):
-    update.increment_view_number(question_id)
+    """
+    :return: the version and updated_at of the question page (see server.py), None for a missing question
+    """
+    question = update.increment_view_number(question_id)
+    if question:
+        # the view counter changes on every page load, so the cached rows are updated instead of invalidated
+        for table in ('question', 'question_page'):
+            entity_cache.update((table, str(question_id)), {'view_number': question['view_number']})
+    return question
+
+
+def handle_votes(vote_option, message_id, message_type, user_id):
+    """
+    Records the user's vote in the vote ledger, a user has at most one vote on a message.
+    The vote counters and the reputations are updated later, in batches, by apply_pending_votes().
+    """
+    value = 1 if vote_option == 'Upvote' else -1
+    target_type = 'answer' if message_type == 'answer' else 'question'
+    insert.vote(user_id, target_type, message_id, value)
+
+
+def apply_pending_votes():
+    applied = update.apply_pending_votes(REPUTATION_FOR_VOTES)
+    return applied
+
+
+def refresh_hot_scores():
+    refreshed = update.refreshed_hot_scores()
+    return {'questions': refreshed}
+
+
+def similarity_index_entry(title, message):
+    """:return: the minhash and similarity_buckets of a question, as stored by insert.question()"""
+    signature = similarity.signature(title, message)
+    if signature is None:
+        # an empty signature marks a question without words as indexed
+        return {'minhash': b'', 'similarity_buckets': []}
+    return {'minhash': similarity.pack(signature), 'similarity_buckets': similarity.buckets(signature)}
 
 
-def handle_votes(vote_option, message_id, message_type):
-    vote_calculation = 'vote_number + 1' if vote_option == 'Upvote' else 'vote_number - 1'
-    table = 'answer' if message_type == 'answer' else 'question'
-    update.votes(vote_calculation, message_id, table)
+def index_similar_questions(questions):
+    """:param questions: dictionaries with the id, title and message of the questions"""
+    update.question_similarity([dict(similarity_index_entry(question['title'], question['message']), id=question['id'])
+                                for question in questions])
+
+
+def index_unindexed_questions(chunk_size):
+    """
+    Adds the questions asked before the similarity index existed to it, chunk_size questions at a time.
+    :return: number of indexed questions
+    """
+    indexed = 0
+    while True:
+        questions = select.questions_missing_from_similarity_index(chunk_size)
+        if not questions:
+            return {'questions': indexed}
+        index_similar_questions(questions)
+        indexed += len(questions)
+
+
+def recompute_reputations(chunk_size):
+    """
+    Recomputes every user's reputation from the vote ledger and the accepted answers with the current rules
+    (plus the reputation earned before the ledger, which can't be recomputed),
+    chunk_size users per transaction, so only a chunk of user_data rows is locked at a time.
+    :return: number of processed chunks and of changed users
+    """
+    id_range = select.user_id_range()
+    chunks, changed_users = 0, 0
+    if id_range['first_id'] is None:
+        return {'chunks': chunks, 'changed_users': changed_users}
+
+    for first_user_id in range(id_range['first_id'], id_range['last_id'] + 1, chunk_size):
+        changed_users += update.recalculated_reputation(first_user_id, first_user_id + chunk_size - 1,
+                                                        REPUTATION_FOR_VOTES, REPUTATION_FOR_ACCEPTED_ANSWER)
+        chunks += 1
+
+    return {'chunks': chunks, 'changed_users': changed_users}
+
+
+def maintain_partitions(months_ahead, archive_after_months=None, archive_tablespace=None):
+    """
+    Creates the answer and comment partitions of the coming months_ahead months, and if archive_after_months is given,
+    moves the partitions older than that many months to archive_tablespace.
+    :return: number of created and archived partitions by table
+    """
+    report = {'created': update.created_partitions(months_ahead)}
+    if archive_after_months is not None:
+        report['archived'] = update.archived_partitions(archive_after_months, archive_tablespace)
+    return report
 
 
 def handle_accepted_answer(question_id, answer_id):
     update.accepted_answer(question_id, answer_id)
+    invalidate_entry('question', question_id)
 
 
-def handle_user_reputation(vote_option, message_id, *message_type):
-    if 'question' in message_type:
-        reputation_calculation = 'reputation + 5' if vote_option == 'Upvote' else 'reputation - 2'
-        user_id = str(select.user_id_for_question(message_id))
-    elif 'answer' in message_type:
-        reputation_calculation = 'reputation + 10' if vote_option == 'Upvote' else 'reputation -2'
-        user_id = str(select.user_id_for_answer(message_id))
-    else:
-        reputation_calculation = 'reputation + 15'
-        user_id = str(select.user_id_for_answer(message_id))
-
+def handle_accepted_answer_reputation(answer_id):
+    reputation_calculation = f'reputation + {REPUTATION_FOR_ACCEPTED_ANSWER}'
+    user_id = str(select.user_id_for_answer(answer_id))
     update.reputation(reputation_calculation, user_id)
 
 # ------------------------------------------------------------------
@@ -226,18 +437,32 @@ def handle_user_reputation(vote_option, message_id, *message_type):
 
 def delete_question(question_id):
     delete.question(question_id)
+    invalidate_entry('question', question_id)
 
 
 def delete_answer(answer_id):
-    delete.answer(answer_id)
+    question_id = delete.answer(answer_id)
+    invalidate_entry('answer', answer_id)
+    invalidate_entry('question', question_id)
 
 
 def delete_tag(question_id, tag_id):
     delete.tag(question_id, tag_id)
+    invalidate_entry('question', question_id)
+    tag_index.refresh_tag(tag_id)
 
 
 def delete_comment(comment_id):
-    delete.comment(comment_id)
+    question_id = delete.comment(comment_id)
+    invalidate_entry('comment', comment_id)
+    invalidate_entry('question', question_id)
+
+
+def delete_in_bulk(question_ids, answer_ids, comment_ids, user_ids):
+    deleted = delete.bulk(question_ids, answer_ids, comment_ids, user_ids)
+    entity_cache.clear()
+    search_cache.clear()
+    return deleted
 
 
 # ------------------------------------------------------------------
@@ -246,16 +471,83 @@ def delete_comment(comment_id):
 
 
 def get_search_results(search_phrase):
-    questions = select.questions_by_search_phrase(search_phrase)
-    questions = util.split_text_values_in_search_results(questions, ['title', 'message'], search_phrase)
-
-    answers = select.answers_by_search_phrase(search_phrase)
-    answers = util.split_text_values_in_search_results(answers, ['message'], search_phrase)
-
-    answers_by_question_id = util.get_answers_by_question_id(answers)
-    search_results = util.merge_answers_by_question_id_into_questions(answers_by_question_id, questions)
-
-    return search_results
+    """
+    Generator of the questions matching the search phrase, each with its matching answers in question['answers'].
+    Result sets of up to SEARCH_CACHE_MAX_RESULTS questions are kept in the search cache, so searching the same
+    phrase again doesn't query the database. Otherwise the rows are read from a server-side cursor and highlighted
+    one question at a time, so the page can be streamed while the results are read, and they are never all in memory.
+    :param search_phrase: normalized with util.normalize_search_phrase(), the key of the cached results.
+        An empty phrase finds nothing, instead of every question
+    """
+    if not search_phrase:
+        return
+    cached_results = search_cache.get(search_phrase)
+    if cached_results is not None:
+        for result in cached_results:
+            yield highlighted_search_result(result)
+        return
+
+    version = search_cache.version
+    results = []
+    for result in read_search_results(search_phrase):
+        if results is not None:
+            results.append(result)
+            if len(results) > SEARCH_CACHE_MAX_RESULTS:
+                results = None
+        yield highlighted_search_result(result)
+    if results is not None:
+        search_cache.set(search_phrase, results, version)
+
+
+def read_search_results(search_phrase):
+    """Generator of the SearchResult of every question found, with the spans of the phrase in its texts."""
+    rows = select.search_results(search_phrase)
+    for question_id, question_rows in itertools.groupby(rows, key=lambda row: row['question_id']):
+        question_rows = list(question_rows)
+        title, message = question_rows[0]['title'], question_rows[0]['question_message']
+        answers = tuple(
+            AnswerResult(row['answer_id'], row['answer_message'],
+                         util.search_phrase_spans(search_phrase, row['answer_message']))
+            for row in question_rows if row['answer_id'] is not None
+        )
+        yield SearchResult(question_id, question_rows[0]['submission_time'],
+                           title, util.search_phrase_spans(search_phrase, title),
+                           message, util.search_phrase_spans(search_phrase, message), answers)
+
+
+def invalidate_search_texts(question_ids, answer_ids):
+    """
+    Drops the cached searches matching the new texts of the questions and answers written in another worker
+    (see invalidation.py). The texts are read with one query, only if there are cached searches.
+    """
+    if not (question_ids or answer_ids) or not len(search_cache):
+        return
+    try:
+        posts = select.post_texts(question_ids, answer_ids)
+    except connection.DatabaseUnavailable:
+        # without the texts any cached search may be out of date
+        search_cache.clear()
+        return
+    search_cache.invalidate_text(*[text for post in posts for text in post])
+
+
+def highlighted_search_result(result):
+    """
+    :param result: SearchResult
+    :return: the question as search/all_results.html shows it: its title and message split at the occurrences
+        of the phrase (a message without any is left out), with its answers
+    """
+    return {
+        'id': result.id,
+        'submission_time': result.submission_time,
+        'title': util.split_text_at_spans(result.title, result.title_spans),
+        'message': util.split_text_at_spans(result.message, result.message_spans) if result.message_spans else [],
+        'answers': [
+            {'id': answer.id, 'question_id': result.id,
+             'message': util.split_text_at_spans(answer.message, answer.message_spans)}
+            for answer in result.answers
+        ]
+    }
 
 
 # ------------------------------------------------------------------
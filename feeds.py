@@ -0,0 +1,64 @@
+# Atom feeds of the recent questions, of the questions of a tag and of a user's activity, for the integrations
+# polling the site instead of scraping the question lists.
+# Every feed reads at most FEED_ENTRIES entries, and its rendered XML is kept in memory with the feed version it was
+# built at (see feed_version in ask_mate_update.sql): every write the feed shows (a question, answer, comment or tag
+# added, edited or deleted) bumps that version, so a poll costs the version lookup, or nothing more than a 304.
+# The compressed variants are kept with the rendered feed: the feeds have weak ETags, whose variants the compression
+# middleware doesn't keep, so they would be compressed again for every poll.
+import os
+import compression
+from cache import LRUCache
+
+FEED_ENTRIES = int(os.environ.get('ASKMATE_FEED_ENTRIES', 20))
+# characters of the message shown in an entry's summary
+SUMMARY_LENGTH = 500
+FEED_CACHE_SIZE = int(os.environ.get('ASKMATE_FEED_CACHE_SIZE', 1000))
+
+# feed key -> (feed version, rendered feed, {encoding: compressed feed})
+feed_cache = LRUCache(FEED_CACHE_SIZE)
+
+
+def cached_feed(key, version, build, encoding=None):
+    """
+    :param key: tuple naming the feed, e.g. ('tag', 'python')
+    :param version: the current version of the feed
+    :param build: function rendering the feed, returning None if there is no such feed (e.g. an unknown tag)
+    :param encoding: the encoding the client accepts (see compression.accepted_encoding()), None for none
+    :return: the feed's body and its encoding (None if it isn't compressed), None if there is no such feed
+    """
+    entry = feed_cache.get(key)
+    if entry is None or entry[0] != version:
+        feed = build()
+        if feed is None:
+            return None
+        entry = (version, feed.encode(), {})
+        feed_cache.set(key, entry)
+
+    _, feed, variants = entry
+    if encoding is None or len(feed) < compression.MINIMUM_SIZE:
+        return feed, None
+    if encoding not in variants:
+        variants[encoding] = compression.compress(feed, encoding)
+    return variants[encoding], encoding
+
+
+def atom_datetime(value):
+    """RFC 3339 date-time of a datetime, the naive ones (e.g. submission_time) are in the server's local time."""
+    if value.tzinfo is None:
+        value = value.astimezone()
+    return value.isoformat(timespec='seconds')
+
+
+def entry_title(entry):
+    titles = {'question': '{}', 'answer': 'Answer to: {}', 'comment': 'Comment on: {}'}
+    return titles[entry.kind].format(entry.title)
+
+
+def init_app(app):
+    app.add_template_filter(atom_datetime)
+    app.add_template_filter(entry_title)
+
+
+def stats():
+    return feed_cache.stats()
+
@@ -0,0 +1,37 @@
+# Settings for serving the app in production with gunicorn: gunicorn wsgi:app
+# Every setting can be overridden with the environment variables below.
+import multiprocessing
+import os
+
+bind = os.environ.get('ASKMATE_BIND', '0.0.0.0:8000')
+
+# the usual (2 x cores) + 1 processes, each with a few threads to overlap the database round trips
+workers = int(os.environ.get('ASKMATE_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('ASKMATE_THREADS', 4))
+worker_class = 'gthread'
+
+# every thread of a worker may hold a database connection at the same time, and a streamed search holds its own
+# for as long as the client takes to read the page, so the pool has room for as many streamed responses again
+stream_connections = int(os.environ.get('ASKMATE_STREAM_CONNECTIONS', threads))
+os.environ.setdefault('ASKMATE_DB_POOL_MAX_SIZE', str(threads + stream_connections))
+
+# import the app and compile its templates once in the master, before forking the workers
+preload_app = True
+
+# workers are restarted now and then (not all at once) to keep their memory in check,
+# and get this long to finish their requests on restart (HUP) or shutdown
+max_requests = int(os.environ.get('ASKMATE_MAX_REQUESTS', 5000))
+max_requests_jitter = max_requests // 10
+graceful_timeout = int(os.environ.get('ASKMATE_GRACEFUL_TIMEOUT', 30))
+timeout = int(os.environ.get('ASKMATE_TIMEOUT', 30))
+
+
+def post_fork(server, worker):
+    # database connections and threads can't be shared with the master, so they are only created in the workers
+    import wsgi
+    wsgi.warm_up_worker()
+
+
+def worker_exit(server, worker):
+    import wsgi
+    wsgi.shut_down_worker()
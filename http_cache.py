@@ -0,0 +1,44 @@
+# Conditional GETs of the pages built from versioned rows (see question.version and question_list_version in
+# ask_mate_update.sql). The pages carry a weak ETag made of the versions they show and a Last-Modified, so a browser
+# or crawler asking again with If-None-Match / If-Modified-Since gets a 304 before any page query runs.
+# The ETags are weak: the view counters and the reputations shown on the pages don't change the versions.
+from flask import current_app, make_response, request, session
+from werkzeug.http import is_resource_modified
+
+
+def shared_etag(*versions):
+    """ETag of a page that is the same for every user, e.g. a feed."""
+    return '-'.join(str(version) for version in versions)
+
+
+def page_etag(*versions):
+    """The pages differ for every logged in user, so the user is part of the ETag."""
+    return shared_etag(*versions, session.get('user_id', 'anonymous'))
+
+
+def conditional_response(etag, last_modified, render, shared=False):
+    """
+    :param etag: e.g. from page_etag()
+    :param last_modified: aware datetime of the last change of anything the page shows
+    :param render: function building the page, only called if the client's copy is outdated
+    :param shared: the page doesn't depend on the session (e.g. a feed, see shared_etag()), so caches may share it
+    :return: 304 response, or the built page, with the validators set
+    """
+    # flashed messages are only shown once, and the client's copy doesn't have them
+    flashes = not shared and '_flashes' in session
+    if not flashes and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    # browsers and shared caches have to revalidate, which is cheap
+    response.cache_control.no_cache = True
+    if shared:
+        response.cache_control.public = True
+    else:
+        # the pages depend on the session cookie, so shared caches mustn't store them
+        response.cache_control.private = True
+        response.vary.add('Cookie')
+    return response
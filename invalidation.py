@@ -0,0 +1,85 @@
+# Keeps the caches of every worker correct when another worker (or host) writes to the database.
+# The triggers in ask_mate_update.sql send a notification on the askmate_invalidate channel for every changed row,
+# and every worker runs a background thread listening on that channel and evicting the changed rows.
+# A new or edited question or answer may match any cached search: the listener reads the new texts of a burst of
+# notifications at once, and drops the cached searches they match.
+import json
+import select
+import threading
+import time
+import psycopg2
+import connection
+import data_manager
+import tag_index
+
+CHANNEL = 'askmate_invalidate'
+RECONNECT_DELAY = 5
+CACHED_TABLES = ('question', 'answer', 'comment')
+SEARCHED_TABLES = ('question', 'answer')
+
+_listener = None
+_listener_lock = threading.Lock()
+_stop = threading.Event()
+
+
+def handle_notification(payload, changed_tag_ids, changed_texts):
+    """
+    :param changed_tag_ids: set collecting the tags to refresh, once for a burst of notifications
+    :param changed_texts: {'question': set(), 'answer': set()} collecting the posts whose new texts are read
+        for the search cache, once for a burst of notifications
+    """
+    change = json.loads(payload)
+    if change['table'] in CACHED_TABLES and change['id'] is not None:
+        data_manager.invalidate_entry(change['table'], change['id'])
+    if change['question_id'] is not None:
+        data_manager.invalidate_entry('question', change['question_id'])
+    if change['tag_id'] is not None:
+        changed_tag_ids.add(change['tag_id'])
+    if change['table'] in SEARCHED_TABLES and change['text_changed']:
+        changed_texts[change['table']].add(change['id'])
+
+
+def listen():
+    while not _stop.is_set():
+        db_connection = None
+        try:
+            db_connection = connection.open_database()
+            db_connection.cursor().execute(f'LISTEN {CHANNEL}')
+            # anything written while this worker wasn't listening could have been missed
+            data_manager.entity_cache.clear()
+            data_manager.search_cache.clear()
+            if tag_index.is_loaded():
+                tag_index.load()
+
+            while not _stop.is_set():
+                if select.select([db_connection], [], [], 1) == ([], [], []):
+                    continue
+                db_connection.poll()
+                changed_tag_ids = set()
+                changed_texts = {table: set() for table in SEARCHED_TABLES}
+                while db_connection.notifies:
+                    handle_notification(db_connection.notifies.pop(0).payload, changed_tag_ids, changed_texts)
+                tag_index.refresh_tags(changed_tag_ids)
+                data_manager.invalidate_search_texts(changed_texts['question'], changed_texts['answer'])
+        except psycopg2.Error as exception:
+            print(f'Cache invalidation listener lost the database connection: {exception}')
+            time.sleep(RECONNECT_DELAY)
+        finally:
+            if db_connection is not None:
+                db_connection.close()
+
+
+def start():
+    """Starts the listener thread of this process, unless it is already running. Safe to call after a fork."""
+    global _listener
+    with _listener_lock:
+        # threads don't survive a fork, so a listener inherited from the parent process is never alive
+        if _listener is not None and _listener.is_alive():
+            return
+        _stop.clear()
+        _listener = threading.Thread(target=listen, name='cache-invalidation-listener', daemon=True)
+        _listener.start()
+
+
+def stop():
+    _stop.set()
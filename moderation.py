@@ -0,0 +1,45 @@
+# Bulk removal of spam. Used by the /moderation/delete route and from the command line:
+#     python moderation.py --questions 12 13 --users 7
+# Moderators are listed by username in the ASKMATE_MODERATORS environment variable, separated by commas.
+import argparse
+import json
+import os
+import data_manager
+
+STATIC_FOLDER = os.path.join(os.getcwd(), 'static')
+ENTRY_TYPES = ('questions', 'answers', 'comments', 'users')
+
+
+def is_moderator(username):
+    moderators = os.environ.get('ASKMATE_MODERATORS', '').split(',')
+    return bool(username) and username in moderators
+
+
+def remove_entries(questions=(), answers=(), comments=(), users=()):
+    """
+    Deletes the given entries and everything depending on them in one transaction, then removes their uploaded images.
+    :return: dictionary of the deleted ids by entry type, and the removed image paths
+    """
+    deleted = data_manager.delete_in_bulk(list(questions), list(answers), list(comments), list(users))
+
+    for image in deleted['images']:
+        try:
+            os.remove(os.path.join(STATIC_FOLDER, image))
+        except FileNotFoundError:
+            pass
+
+    return deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Delete questions, answers, comments and users in bulk.')
+    for entry_type in ENTRY_TYPES:
+        parser.add_argument(f'--{entry_type}', nargs='+', type=int, default=[], metavar='ID')
+    args = parser.parse_args()
+
+    deleted = remove_entries(**{entry_type: getattr(args, entry_type) for entry_type in ENTRY_TYPES})
+    print(json.dumps(deleted, indent=4))
+
+
+if __name__ == '__main__':
+    main()
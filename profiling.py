@@ -0,0 +1,141 @@
+# Sampled profiling of live requests. A sample of the requests (ASKMATE_PROFILE_SAMPLE_RATE, 0 to 1), and every request
+# with an X-Askmate-Profile header equal to ASKMATE_PROFILE_TOKEN, runs under cProfile. The profiles are written to
+# ASKMATE_PROFILE_DIR (the newest ASKMATE_PROFILE_KEEP are kept) next to a JSON file with the route, the duration and
+# the time spent in the queries package. The profiles can be opened with pstats or snakeviz,
+# and the hotspots of the recent ones are listed by /admin/hotspots.
+import cProfile
+import glob
+import hmac
+import json
+import os
+import pstats
+import random
+import re
+import tempfile
+import threading
+import time
+from flask import g, request
+
+SAMPLE_RATE = float(os.environ.get('ASKMATE_PROFILE_SAMPLE_RATE', 0))
+TOKEN = os.environ.get('ASKMATE_PROFILE_TOKEN')
+PROFILE_HEADER = 'X-Askmate-Profile'
+PROFILE_DIR = os.environ.get('ASKMATE_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'askmate-profiles'))
+KEEP_PROFILES = int(os.environ.get('ASKMATE_PROFILE_KEEP', 200))
+QUERIES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'queries')
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+MEMORY_ADDRESS = re.compile(r' at 0x[0-9a-f]+')
+
+# cProfile can't run twice at the same time (Python 3.12+), so a worker profiles one request at a time
+_profiler_lock = threading.Lock()
+
+
+def is_requested():
+    token = request.headers.get(PROFILE_HEADER)
+    if TOKEN and token and hmac.compare_digest(token, TOKEN):
+        return True
+    return SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE
+
+
+def start_profiling():
+    if not is_requested() or not _profiler_lock.acquire(blocking=False):
+        return
+    g.profiler = cProfile.Profile()
+    g.profile_started_at = time.perf_counter()
+    g.profiler.enable()
+
+
+def stop_profiling(exception=None):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    try:
+        profiler.disable()
+        save_profile(profiler, time.perf_counter() - g.pop('profile_started_at'))
+    finally:
+        _profiler_lock.release()
+
+
+def save_profile(profiler, seconds):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    endpoint = request.endpoint or 'unknown'
+    # the names sort by time, the oldest are removed first
+    name = f'{time.time():.6f}-{os.getpid()}-{endpoint}'
+    path = os.path.join(PROFILE_DIR, name)
+    profiler.dump_stats(path + '.prof')
+
+    stats = pstats.Stats(profiler)
+    summary = {
+        'name': name,
+        'endpoint': endpoint,
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'seconds': round(seconds, 6),
+        'query_seconds': round(query_seconds(stats), 6)
+    }
+    with open(path + '.json', 'w') as summary_file:
+        json.dump(summary, summary_file)
+    remove_old_profiles()
+
+
+def query_seconds(stats):
+    """Time spent in the functions of the queries package (including the database round trips they wait for)."""
+    # the query functions don't call each other, so their cumulative times don't overlap
+    return sum(cumulative_time for (filename, _, _), (_, _, _, cumulative_time, _) in stats.stats.items()
+               if filename.startswith(QUERIES_DIR))
+
+
+def remove_old_profiles():
+    profiles = sorted(glob.glob(os.path.join(PROFILE_DIR, '*.prof')))
+    for profile_path in profiles[:-KEEP_PROFILES]:
+        for path in (profile_path, profile_path[:-len('.prof')] + '.json'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def recent_profiles(limit=50):
+    """:return: summaries of the newest profiles, newest first"""
+    summaries = []
+    for summary_path in sorted(glob.glob(os.path.join(PROFILE_DIR, '*.json')), reverse=True)[:limit]:
+        try:
+            with open(summary_path) as summary_file:
+                summaries.append(json.load(summary_file))
+        except (OSError, ValueError):
+            # removed or still being written by another worker
+            continue
+    return summaries
+
+
+def hotspots(profiles, limit=30):
+    """
+    Adds up the given profiles.
+    :return: the functions with the most own time (not counting the functions they call), the slowest first
+    """
+    paths = [os.path.join(PROFILE_DIR, profile['name'] + '.prof') for profile in profiles]
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        return []
+    stats = pstats.Stats(*paths)
+    total_time = stats.total_tt or 1
+
+    functions = {}
+    for (filename, line, function_name), (_, calls, own_time, cumulative_time, _) in stats.stats.items():
+        # built-in functions have no file, and their names contain the address of the object in the profiled process
+        location = '' if filename == '~' else f'{os.path.relpath(filename, PROJECT_DIR)}:{line}'
+        key = (location, MEMORY_ADDRESS.sub('', function_name))
+        function = functions.setdefault(key, {'location': location, 'function': key[1], 'calls': 0,
+                                              'own_seconds': 0, 'cumulative_seconds': 0})
+        function['calls'] += calls
+        function['own_seconds'] += own_time
+        function['cumulative_seconds'] += cumulative_time
+
+    slowest = sorted(functions.values(), key=lambda function: function['own_seconds'], reverse=True)[:limit]
+    for function in slowest:
+        function['own_percent'] = 100 * function['own_seconds'] / total_time
+    return slowest
+
+
+def init_app(app):
+    app.before_request(start_profiling)
+    app.teardown_request(stop_profiling)
@@ -7,8 +7,20 @@ def question(cursor, question_id):
     cursor.execute(
         """
         DELETE FROM question_tag WHERE question_id = %(question_id)s;
-        DELETE FROM comment WHERE question_id = %(question_id)s;
-        DELETE FROM answer WHERE question_id = %(question_id)s;
+        DELETE FROM comment
+        WHERE question_id = %(question_id)s OR
+              answer_id IN (SELECT id FROM answer WHERE question_id = %(question_id)s AND
+                                                        submission_time >= (SELECT oldest_post_time FROM question
+                                                                            WHERE id = %(question_id)s));
+        UPDATE question SET accepted_answer_id = NULL WHERE id = %(question_id)s;
+        DELETE FROM vote
+        WHERE (target_type = 'question' AND target_id = %(question_id)s) OR
+              (target_type = 'answer' AND target_id IN (SELECT id FROM answer WHERE question_id = %(question_id)s AND
+                                                        submission_time >= (SELECT oldest_post_time FROM question
+                                                                            WHERE id = %(question_id)s)));
+        DELETE FROM answer
+        WHERE question_id = %(question_id)s AND
+              submission_time >= (SELECT oldest_post_time FROM question WHERE id = %(question_id)s);
         DELETE FROM question WHERE id = %(question_id)s;
         """,
         {'question_id': question_id})
@@ -18,9 +30,17 @@ def question(cursor, question_id):
 def answer(cursor, answer_id):
     cursor.execute("""
                    DELETE FROM comment WHERE answer_id=%(answer_id)s;
-                   DELETE FROM answer WHERE id=%(answer_id)s;
+                   DELETE FROM vote WHERE target_type = 'answer' AND target_id = %(answer_id)s;
+                   UPDATE question SET accepted_answer_id = NULL WHERE accepted_answer_id = %(answer_id)s;
+                   DELETE FROM answer
+                   WHERE id=%(answer_id)s AND
+                         submission_time = (SELECT submission_time FROM answer_key WHERE id = %(answer_id)s)
+                   RETURNING question_id;
                    """,
                    {'answer_id': answer_id})
+    answer_data = cursor.fetchone()
+    if answer_data:
+        return answer_data['question_id']
 
 
 @connection.connection_handler
@@ -36,6 +56,99 @@ def tag(cursor, question_id, tag_id):
 def comment(cursor, comment_id):
     cursor.execute(
         """
-        DELETE FROM comment WHERE id=%(comment_id)s;    
+        DELETE FROM comment
+        WHERE id=%(comment_id)s AND
+              submission_time = (SELECT submission_time FROM comment_key WHERE id = %(comment_id)s)
+        RETURNING question_id;
         """,
         {'comment_id': comment_id})
+    comment_data = cursor.fetchone()
+    if comment_data:
+        return comment_data['question_id']
+
+
+@connection.transaction_handler
+def bulk(cursor, question_ids, answer_ids, comment_ids, user_ids):
+    """
+    Deletes the given entries together with everything that depends on them, in one transaction.
+    Deleting a user deletes all of their posts, deleting a question or an answer deletes the answers and comments under it.
+    :return: the ids of every deleted entry by table, and the image paths of the deleted posts
+    """
+    ids = {
+        'question_ids': question_ids,
+        'answer_ids': answer_ids,
+        'comment_ids': comment_ids,
+        'user_ids': user_ids
+    }
+
+    cursor.execute(
+        """
+        SELECT ARRAY(
+            SELECT id FROM question
+            WHERE id = ANY(%(question_ids)s::integer[]) OR user_id = ANY(%(user_ids)s::integer[])
+        ) AS question_ids
+        """,
+        ids)
+    ids.update(cursor.fetchone())
+
+    cursor.execute(
+        """
+        SELECT ARRAY(
+            SELECT id FROM answer
+            WHERE id = ANY(%(answer_ids)s::integer[]) OR
+                  question_id = ANY(%(question_ids)s::integer[]) OR
+                  user_id = ANY(%(user_ids)s::integer[])
+        ) AS answer_ids
+        """,
+        ids)
+    ids.update(cursor.fetchone())
+
+    cursor.execute(
+        """
+        UPDATE question SET accepted_answer_id = NULL
+        WHERE accepted_answer_id = ANY(%(answer_ids)s::integer[]);
+
+        DELETE FROM question_tag WHERE question_id = ANY(%(question_ids)s::integer[]);
+
+        DELETE FROM vote
+        WHERE user_id = ANY(%(user_ids)s::integer[]) OR
+              (target_type = 'question' AND target_id = ANY(%(question_ids)s::integer[])) OR
+              (target_type = 'answer' AND target_id = ANY(%(answer_ids)s::integer[]));
+
+        DELETE FROM comment
+        WHERE id = ANY(%(comment_ids)s::integer[]) OR
+              question_id = ANY(%(question_ids)s::integer[]) OR
+              answer_id = ANY(%(answer_ids)s::integer[]) OR
+              user_id = ANY(%(user_ids)s::integer[])
+        RETURNING id;
+        """,
+        ids)
+    deleted_comments = cursor.fetchall()
+
+    cursor.execute("DELETE FROM answer WHERE id = ANY(%(answer_ids)s::integer[]) RETURNING id, image", ids)
+    deleted_answers = cursor.fetchall()
+
+    cursor.execute("DELETE FROM question WHERE id = ANY(%(question_ids)s::integer[]) RETURNING id, image", ids)
+    deleted_questions = cursor.fetchall()
+
+    cursor.execute("DELETE FROM user_data WHERE id = ANY(%(user_ids)s::integer[]) RETURNING id", ids)
+    deleted_users = cursor.fetchall()
+
+    # an uploaded file may be shared with posts that are kept, those images have to stay
+    images = {row['image'] for row in deleted_answers + deleted_questions if row['image']}
+    cursor.execute(
+        """
+        SELECT image FROM question WHERE image = ANY(%(images)s::text[])
+        UNION
+        SELECT image FROM answer WHERE image = ANY(%(images)s::text[])
+        """,
+        {'images': list(images)})
+    images -= {row['image'] for row in cursor.fetchall()}
+
+    return {
+        'questions': [row['id'] for row in deleted_questions],
+        'answers': [row['id'] for row in deleted_answers],
+        'comments': [row['id'] for row in deleted_comments],
+        'users': [row['id'] for row in deleted_users],
+        'images': sorted(images)
+    }
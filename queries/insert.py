@@ -1,15 +1,26 @@
 import connection
+from psycopg2 import sql
+from queries.select import id_condition
 
 
 @connection.connection_handler
 def question(cursor, question_data):
     cursor.execute(
         """
-        INSERT INTO question (submission_time, view_number, vote_number, title, message, image, user_id)
-        VALUES (%(submission_time)s, %(view_number)s, %(vote_number)s, %(title)s, %(message)s, %(image)s, %(user_id)s);
+        WITH new_question AS (
+            INSERT INTO question (submission_time, view_number, vote_number, title, message, image, user_id, minhash)
+            VALUES (%(submission_time)s, %(view_number)s, %(vote_number)s, %(title)s, %(message)s, %(image)s,
+                    %(user_id)s, %(minhash)s)
+            RETURNING id
+        ), similarity_buckets AS (
+            INSERT INTO question_similarity_bucket (bucket, question_id)
+            SELECT DISTINCT unnest(%(similarity_buckets)s::bigint[]), id FROM new_question
+        )
+        SELECT id FROM new_question;
         """,
         question_data
     )
+    return cursor.fetchone()['id']
 
 
 @connection.connection_handler
@@ -17,8 +28,10 @@ def answer(cursor, new_answer_data):
     cursor.execute("""
                     INSERT INTO answer (submission_time, vote_number, question_id, message, image, user_id)
                     VALUES (%(submission_time)s, %(vote_number)s, %(question_id)s, %(new_answer)s, %(image)s, %(user_id)s)
+                    RETURNING id
                     """,
                    new_answer_data)
+    return cursor.fetchone()['id']
 
 
 @connection.connection_handler
@@ -27,17 +40,23 @@ def comment(cursor, new_comment_data):
                     INSERT INTO comment (answer_id, question_id, message, submission_time, edited_count, user_id)
                     VALUES (%(answer_id)s, %(question_id)s, %(message)s,
                     %(submission_time)s, %(edited_count)s, %(user_id)s)
+                    RETURNING id
                     """,
                    new_comment_data
                    )
+    return cursor.fetchone()['id']
 
 
 @connection.connection_handler
 def tag_into_tag_table(cursor, tag_text):
+    # the names are unique, a tag created by another request meanwhile is returned instead
     cursor.execute("""
                     INSERT INTO tag (name)
                     VALUES ( %(name)s)
+                    ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name
+                    RETURNING id
                     """, {'name': tag_text})
+    return cursor.fetchone()['id']
 
 
 @connection.connection_handler
@@ -45,7 +64,9 @@ def tag_into_question_table(cursor, question_id, tag_id):
     cursor.execute("""
                     INSERT INTO question_tag
                     VALUES (%(question_id)s, %(tag_id)s)
+                    RETURNING *
                     """, {'question_id': question_id, 'tag_id': tag_id})
+    return cursor.fetchone()
 
 
 @connection.connection_handler
@@ -54,6 +75,32 @@ def new_user(cursor, user_data):
         """
         INSERT INTO user_data (username, password, reg_date)
         VALUES (%(username)s, %(password)s, %(reg_date)s)
+        RETURNING id
         """,
         user_data
     )
+    return cursor.fetchone()['id']
+
+
+@connection.connection_handler
+def vote(cursor, user_id, target_type, target_id, value):
+    """
+    Records the user's vote on a question or an answer (target_type is the table name).
+    Voting the same way again changes nothing, voting the other way replaces the earlier vote.
+    :return: the recorded vote, None if nothing changed
+    """
+    cursor.execute(
+        sql.SQL("""
+                INSERT INTO vote (user_id, target_type, target_id, value)
+                SELECT %(user_id)s, %(target_type)s, id, %(value)s
+                FROM {table}
+                WHERE {id_condition}
+                ON CONFLICT (user_id, target_type, target_id) DO UPDATE
+                SET value = EXCLUDED.value
+                WHERE vote.value <> EXCLUDED.value
+                RETURNING *
+                """).format(table=sql.Identifier(target_type),
+                            id_condition=id_condition(target_type, sql.Placeholder('target_id'))),
+        {'user_id': user_id, 'target_type': target_type, 'target_id': target_id, 'value': value}
+    )
+    return cursor.fetchone()
@@ -2,9 +2,29 @@ import connection
 from psycopg2 import sql
 
 
-@connection.connection_handler
+# tables range partitioned by the month of submission_time, see ask_mate_update.sql
+PARTITIONED_TABLES = ('answer', 'comment')
+
+
+def id_condition(table, entry_id):
+    """
+    The condition selecting the row of table with the id entry_id (a psycopg2 Composable, e.g. a Placeholder).
+    The rows of the partitioned tables are looked up with their submission_time from <table>_key,
+    so only the partition holding the row is scanned.
+    """
+    condition = sql.SQL("{table}.id = {entry_id}")
+    if table in PARTITIONED_TABLES:
+        condition = sql.SQL(
+            "{table}.id = {entry_id} AND "
+            "{table}.submission_time = (SELECT submission_time FROM {key_table} WHERE id = {entry_id})"
+        )
+    return condition.format(table=sql.Identifier(table), key_table=sql.Identifier(table + '_key'), entry_id=entry_id)
+
+
+@connection.connection_handler(compact_rows=True)
 def all_questions(cursor, order_by, order):
     """
+    Only selects the columns shown in the question lists, the message and image are left in the database.
     :param cursor: SQL cursor from @connection.connection_handler
     :param order_by:
     :param order:
@@ -13,8 +33,12 @@ def all_questions(cursor, order_by, order):
     cursor.execute(
             sql.SQL("""
                      SELECT
-                        question.*, 
-                        (SELECT COUNT(*) FROM answer WHERE answer.question_id = question.id) AS answer_number
+                        question.id, question.title, question.vote_number, question.view_number,
+                        question.submission_time,
+                        (SELECT COUNT(*) FROM answer
+                         WHERE answer.question_id = question.id AND
+                               answer.submission_time >= question.oldest_post_time)
+                        AS answer_number
                      FROM question
                      ORDER BY {order_by} {order}
                     """).format(order_by=sql.Identifier(order_by), order=sql.SQL(order)))
@@ -23,28 +47,35 @@ def all_questions(cursor, order_by, order):
     return questions
 
 
+connection.prepared_statement(
+    'single_question',
+    """
+    SELECT question.id, question.submission_time, question.view_number, question.vote_number, question.title,
+           question.message, question.image, question.user_id, question.accepted_answer_id, question.version,
+           question.updated_at, question.minhash, user_data.username as username, user_data.reputation as reputation
+    FROM question
+    LEFT JOIN user_data ON question.user_id = user_data.id
+    WHERE question.id = $1
+    """
+)
+
+
 @connection.connection_handler
 def single_question(cursor, question_id):
-    cursor.execute(
-        """
-        SELECT question.*, user_data.username as username, user_data.reputation as reputation
-        FROM question
-        LEFT JOIN user_data ON question.user_id = user_data.id
-        WHERE question.id = %(question_id)s
-        """,
-        {'question_id': question_id}
-    )
+    connection.execute_prepared(cursor, 'single_question', (question_id,))
     question = cursor.fetchone()
     return question
 
 
-@connection.connection_handler
+@connection.connection_handler(compact_rows=True)
 def most_recent_questions(cursor, number_of_entries):
     cursor.execute(
         """
         SELECT
-            question.*,
-            (SELECT COUNT(id) FROM answer WHERE answer.question_id = question.id) AS answer_number
+            question.id, question.title, question.vote_number, question.view_number, question.submission_time,
+            (SELECT COUNT(id) FROM answer
+             WHERE answer.question_id = question.id AND answer.submission_time >= question.oldest_post_time)
+            AS answer_number
             FROM question
             ORDER BY submission_time DESC LIMIT %s;
         """,
@@ -54,56 +85,163 @@ def most_recent_questions(cursor, number_of_entries):
     return questions
 
 
+connection.prepared_statement(
+    'hot_questions',
+    """
+    SELECT
+        question.id, question.title, question.vote_number, question.view_number, question.submission_time,
+        (SELECT COUNT(id) FROM answer
+         WHERE answer.question_id = question.id AND answer.submission_time >= question.oldest_post_time)
+        AS answer_number
+    FROM question
+    ORDER BY hot_score DESC NULLS LAST
+    LIMIT $1
+    """
+)
+
+
+@connection.connection_handler(compact_rows=True)
+def hot_questions(cursor, number_of_entries):
+    """The questions with the most recent activity, read from the index on question.hot_score."""
+    connection.execute_prepared(cursor, 'hot_questions', (number_of_entries,))
+    questions = cursor.fetchall()
+    return questions
+
+
+# the questions sharing the most bucket keys with $1 (see similarity.py), reading at most $2 questions per bucket,
+# so a key shared by very many questions (e.g. of a common title word) doesn't make the lookup slow
+connection.prepared_statement(
+    'similar_question_candidates',
+    """
+    SELECT question.id, question.title, question.minhash, candidate.shared_buckets
+    FROM (
+        SELECT bucket_question.question_id, COUNT(*) AS shared_buckets
+        FROM unnest($1::bigint[]) AS probe(bucket)
+        CROSS JOIN LATERAL (
+            SELECT question_id FROM question_similarity_bucket
+            WHERE question_similarity_bucket.bucket = probe.bucket
+            LIMIT $2
+        ) AS bucket_question
+        GROUP BY bucket_question.question_id
+        ORDER BY shared_buckets DESC
+        LIMIT $3
+    ) AS candidate
+    JOIN question ON question.id = candidate.question_id
+    """
+)
+
+
+@connection.connection_handler(compact_rows=True)
+def similar_question_candidates(cursor, buckets, questions_per_bucket, number_of_candidates):
+    connection.execute_prepared(cursor, 'similar_question_candidates',
+                                (buckets, questions_per_bucket, number_of_candidates))
+    candidates = cursor.fetchall()
+    return candidates
+
+
 @connection.connection_handler
-def answers_for_question(cursor, question_id):
+def questions_missing_from_similarity_index(cursor, number_of_entries):
     cursor.execute(
         """
-        SELECT answer.*, user_data.username as username, user_data.reputation as reputation
-        FROM answer
-        LEFT JOIN question ON answer.id = question.accepted_answer_id
-        LEFT JOIN user_data ON answer.user_id = user_data.id
-        WHERE question_id = %(question_id)s
-        ORDER BY question.accepted_answer_id, submission_time desc;
+        SELECT id, title, message FROM question
+        WHERE minhash IS NULL
+        ORDER BY id LIMIT %s
         """,
-        {'question_id': question_id}
+        (number_of_entries,)
     )
+    questions = cursor.fetchall()
+    return questions
+
+
+connection.prepared_statement(
+    'answers_for_question',
+    """
+    SELECT answer.id, answer.submission_time, answer.vote_number, answer.question_id, answer.message, answer.image,
+           answer.user_id, user_data.username as username, user_data.reputation as reputation
+    FROM answer
+    LEFT JOIN question ON answer.id = question.accepted_answer_id
+    LEFT JOIN user_data ON answer.user_id = user_data.id
+    WHERE answer.question_id = $1 AND
+          answer.submission_time >= (SELECT oldest_post_time FROM question WHERE id = $1)
+    ORDER BY question.accepted_answer_id, submission_time desc
+    """
+)
+
+
+@connection.connection_handler
+def answers_for_question(cursor, question_id):
+    connection.execute_prepared(cursor, 'answers_for_question', (question_id,))
     answers = cursor.fetchall()
     return answers
 
 
+connection.prepared_statement(
+    'all_comments',
+    """
+    SELECT comment.id as id, question_id, answer_id, message, submission_time,
+           COALESCE(edited_count, 0) AS edited_count, user_id, ud.username as username, ud.reputation as
+           reputation
+    FROM comment
+    LEFT JOIN user_data ud on comment.user_id = ud.id
+    WHERE question_id = $1 AND
+          comment.submission_time >= (SELECT oldest_post_time FROM question WHERE id = $1)
+    ORDER BY submission_time DESC
+    """
+)
+
+
 @connection.connection_handler
 def all_comments(cursor, comment_id):
-    cursor.execute(
-        sql.SQL("""
-                    SELECT comment.id as id, question_id, answer_id, message, submission_time,
-                           COALESCE(edited_count, 0) AS edited_count, user_id, ud.username as username, ud.reputation as
-                           reputation
-                    FROM comment
-                    LEFT JOIN user_data ud on comment.user_id = ud.id
-                    WHERE question_id = {comment_id}
-                    ORDER BY submission_time DESC
-                    """).format(comment_id=sql.SQL(comment_id)))
+    connection.execute_prepared(cursor, 'all_comments', (comment_id,))
     comment_data = cursor.fetchall()
     return comment_data
 
 
+connection.prepared_statement(
+    'question_list_version',
+    """
+    SELECT version, updated_at FROM question_list_version
+    """
+)
+
+
+@connection.connection_handler
+def question_list_version(cursor):
+    connection.execute_prepared(cursor, 'question_list_version')
+    list_version = cursor.fetchone()
+    return list_version
+
+
+# a feed without a row hasn't changed since the feed versions were added (see ask_mate_update.sql)
+connection.prepared_statement(
+    'feed_version',
+    """
+    SELECT COALESCE(MAX(version), 0) AS version, COALESCE(MAX(updated_at), 'epoch') AS updated_at
+    FROM feed_version
+    WHERE feed = $1
+    """
+)
+
+
 @connection.connection_handler
-def latest_id(cursor, table):
-    cursor.execute(sql.SQL("SELECT id FROM {} ORDER BY id DESC LIMIT 1;").format(
-        sql.Identifier(table)
-    ))
-    entry_data = cursor.fetchone()
-    return entry_data['id']
+def feed_version(cursor, feed):
+    connection.execute_prepared(cursor, 'feed_version', (feed,))
+    version = cursor.fetchone()
+    return version
+
+
+connection.prepared_statement(
+    'all_question_ids',
+    """
+    SELECT id FROM question
+    ORDER BY id
+    """
+)
 
 
 @connection.connection_handler
 def all_question_ids(cursor):
-    cursor.execute(
-        """
-        SELECT id FROM question
-        ORDER BY id;
-        """
-    )
+    connection.execute_prepared(cursor, 'all_question_ids')
     questions = cursor.fetchall()
     return [question['id'] for question in questions]
 
@@ -114,98 +252,241 @@ def single_entry(cursor, table, entry_id):
         sql.SQL(
             """
             SELECT * FROM {table}
-            WHERE id = %(entry_id)s
+            WHERE {id_condition}
             """
-        ).format(table=sql.Identifier(table)),
+        ).format(table=sql.Identifier(table), id_condition=id_condition(table, sql.Placeholder('entry_id'))),
         {'entry_id': entry_id}
     )
     entry = cursor.fetchone()
     return entry
 
 
+connection.prepared_statement(
+    'tags_for_question',
+    """
+    SELECT id, name
+    FROM tag
+    JOIN question_tag as qt on tag.id = qt.tag_id
+    WHERE qt.question_id = $1
+    """
+)
+
+
 @connection.connection_handler
 def tags_for_question(cursor, question_id):
-    cursor.execute("""
-                    SELECT id, name
-                    FROM tag
-                    JOIN question_tag as qt on tag.id = qt.tag_id
-                    WHERE qt.question_id = %(question_id)s
-                    """, {'question_id': question_id})
+    connection.execute_prepared(cursor, 'tags_for_question', (question_id,))
     tags = cursor.fetchall()
     return tags
 
 
 @connection.connection_handler
-def existing_tags_for_question(cursor, question_id):
+def tags_with_usage(cursor):
     cursor.execute("""
-                    SELECT id, name
+                    SELECT id, name, question_count AS count
                     FROM tag
-                    WHERE tag.id not in (SELECT tag_id
-                    FROM question_tag
-                    WHERE question_id=%(question_id)s)
-                    ORDER BY id
-                    """, {'question_id': question_id})
-    existing_tags = cursor.fetchall()
-    return existing_tags
+                    """)
+    tags = cursor.fetchall()
+    return tags
 
 
 @connection.connection_handler
-def tag_id(cursor, tag_text):
+def tags_with_usage_by_id(cursor, tag_ids):
     cursor.execute("""
-                    SELECT id
+                    SELECT id, name, question_count AS count
                     FROM tag
-                    WHERE name=%(tag_text)s
-                    """, {'tag_text': tag_text})
-    tag = cursor.fetchone()
-    return tag['id']
+                    WHERE id = ANY(%(tag_ids)s::integer[])
+                    """, {'tag_ids': list(tag_ids)})
+    tags = cursor.fetchall()
+    return tags
 
 
 @connection.connection_handler
 def tags_counted(cursor):
+    # question_count is maintained by a trigger on question_tag, and the names are unique (see ask_mate_update.sql)
     cursor.execute("""
-                    SELECT tag.name, COUNT(question_id) as count
+                    SELECT name, question_count AS count
                     FROM tag
-                    RIGHT JOIN question_tag qt on tag.id = qt.tag_id
-                    GROUP BY tag.name
+                    WHERE question_count > 0
+                    ORDER BY name
                     """)
     tags_counted = cursor.fetchall()
     return tags_counted
 
 
 @connection.connection_handler
-def questions_by_search_phrase(cursor, search_phrase):
-    search_phrase = '%' + search_phrase.lower() + '%'
+def tag_by_name(cursor, tag_name):
+    cursor.execute("""
+                    SELECT id, name, question_count
+                    FROM tag
+                    WHERE name = %(tag_name)s
+                    """, {'tag_name': tag_name})
+    tag = cursor.fetchone()
+    return tag
+
+
+@connection.connection_handler(compact_rows=True)
+def questions_for_tag(cursor, tag_id, before_question_id, number_of_entries):
+    """
+    One page of the questions with the tag, newest first. Uses keyset pagination on the question ids
+    (served by the index on question_tag (tag_id, question_id)), so later pages are as cheap as the first one.
+    :param before_question_id: only questions with a smaller id are listed, None for the first page
+    """
     cursor.execute(
         """
-        SELECT DISTINCT q.id, q.submission_time, q.title, q.message
-        FROM question q
-        LEFT JOIN answer a on q.id = a.question_id
-        WHERE
-            LOWER(q.title) LIKE %(search_phrase)s OR
-            LOWER(q.message) LIKE %(search_phrase)s OR
-            LOWER(a.message) LIKE %(search_phrase)s
-        ORDER BY q.submission_time DESC
+        SELECT
+            question.id, question.title, question.vote_number, question.view_number, question.submission_time,
+            (SELECT COUNT(id) FROM answer
+             WHERE answer.question_id = question.id AND answer.submission_time >= question.oldest_post_time)
+            AS answer_number
+        FROM question_tag qt
+        JOIN question ON question.id = qt.question_id
+        WHERE qt.tag_id = %(tag_id)s AND (%(before)s IS NULL OR qt.question_id < %(before)s)
+        ORDER BY qt.question_id DESC
+        LIMIT %(limit)s
         """,
-        {'search_phrase': search_phrase}
+        {'tag_id': tag_id, 'before': before_question_id, 'limit': number_of_entries}
     )
     questions = cursor.fetchall()
     return questions
 
 
-@connection.connection_handler
-def answers_by_search_phrase(cursor, search_phrase):
+@connection.connection_handler(compact_rows=True)
+def recent_question_feed_entries(cursor, number_of_entries, summary_length):
+    """Entries of the recent questions feed (see feeds.py): the newest questions, their message cut short."""
+    cursor.execute(
+        """
+        SELECT
+            'question' AS kind, question.id, question.id AS question_id, question.title,
+            LEFT(question.message, %(summary_length)s) AS summary, question.updated_at, user_data.username
+        FROM question
+        LEFT JOIN user_data ON user_data.id = question.user_id
+        ORDER BY question.submission_time DESC
+        LIMIT %(limit)s
+        """,
+        {'limit': number_of_entries, 'summary_length': summary_length}
+    )
+    entries = cursor.fetchall()
+    return entries
+
+
+@connection.connection_handler(compact_rows=True)
+def tag_question_feed_entries(cursor, tag_id, number_of_entries, summary_length):
+    """Entries of a tag's feed, read from the question_tag (tag_id, question_id) index like questions_for_tag()."""
+    cursor.execute(
+        """
+        SELECT
+            'question' AS kind, question.id, question.id AS question_id, question.title,
+            LEFT(question.message, %(summary_length)s) AS summary, question.updated_at, user_data.username
+        FROM question_tag qt
+        JOIN question ON question.id = qt.question_id
+        LEFT JOIN user_data ON user_data.id = question.user_id
+        WHERE qt.tag_id = %(tag_id)s
+        ORDER BY qt.question_id DESC
+        LIMIT %(limit)s
+        """,
+        {'tag_id': tag_id, 'limit': number_of_entries, 'summary_length': summary_length}
+    )
+    entries = cursor.fetchall()
+    return entries
+
+
+@connection.connection_handler(compact_rows=True)
+def user_activity_feed_entries(cursor, user_id, number_of_entries, summary_length):
+    """
+    Entries of a user's feed: the newest of the user's questions, answers and comments, each kind read with its own
+    limit from the user_id indexes. A user without any activity has a single row with NULL kind, no rows
+    mean there is no such user.
+    """
+    cursor.execute(
+        """
+        SELECT
+            activity.kind, activity.id, activity.question_id, activity.title, activity.summary,
+            activity.updated_at, user_data.username
+        FROM user_data
+        LEFT JOIN LATERAL (
+            (SELECT
+                'question' AS kind, question.id, question.id AS question_id, question.title,
+                LEFT(question.message, %(summary_length)s) AS summary, question.updated_at
+             FROM question
+             WHERE question.user_id = user_data.id
+             ORDER BY question.submission_time DESC
+             LIMIT %(limit)s)
+            UNION ALL
+            (SELECT
+                'answer', answer.id, answer.question_id, question.title,
+                LEFT(answer.message, %(summary_length)s), answer.submission_time
+             FROM answer
+             JOIN question ON question.id = answer.question_id
+             WHERE answer.user_id = user_data.id
+             ORDER BY answer.submission_time DESC
+             LIMIT %(limit)s)
+            UNION ALL
+            (SELECT
+                'comment', comment.id, comment.question_id, question.title,
+                LEFT(comment.message, %(summary_length)s), comment.submission_time
+             FROM comment
+             JOIN question ON question.id = comment.question_id
+             WHERE comment.user_id = user_data.id
+             ORDER BY comment.submission_time DESC
+             LIMIT %(limit)s)
+            ORDER BY updated_at DESC
+            LIMIT %(limit)s
+        ) AS activity ON true
+        WHERE user_data.id = %(user_id)s
+        """,
+        {'user_id': user_id, 'limit': number_of_entries, 'summary_length': summary_length}
+    )
+    entries = cursor.fetchall()
+    return entries
+
+
+@connection.connection_handler(compact_rows=True)
+def post_texts(cursor, question_ids, answer_ids):
+    """The title and message of the questions, and the message of the answers (with a NULL title)."""
+    cursor.execute(
+        """
+        SELECT title, message FROM question
+        WHERE id = ANY(%(question_ids)s::integer[])
+        UNION ALL
+        SELECT NULL, answer.message
+        FROM answer_key
+        JOIN answer ON answer.id = answer_key.id AND answer.submission_time = answer_key.submission_time
+        WHERE answer_key.id = ANY(%(answer_ids)s::integer[])
+        """,
+        {'question_ids': list(question_ids), 'answer_ids': list(answer_ids)}
+    )
+    texts = cursor.fetchall()
+    return texts
+
+
+@connection.streaming_handler
+def search_results(cursor, search_phrase):
+    """
+    Yields the questions containing the search phrase or having an answer containing it, the most recent first.
+    A question has one row per matching answer (or a single row with a NULL answer_id if none matches),
+    and the rows of a question follow each other, so the results can be grouped while they are read.
+    :param cursor: server-side cursor from @connection.streaming_handler
+    """
     search_phrase = '%' + search_phrase.lower() + '%'
     cursor.execute(
         """
-        SELECT a.question_id, a.id, a.message, a.submission_time
-        FROM answer a
-        WHERE LOWER(a.message) LIKE %(search_phrase)s
-        ORDER BY a.question_id
+        SELECT
+            q.id AS question_id, q.submission_time, q.title, q.message AS question_message,
+            a.id AS answer_id, a.message AS answer_message
+        FROM question q
+        LEFT JOIN answer a ON
+            a.question_id = q.id AND
+            a.submission_time >= q.oldest_post_time AND
+            LOWER(a.message) LIKE %(search_phrase)s
+        WHERE
+            LOWER(q.title) LIKE %(search_phrase)s OR
+            LOWER(q.message) LIKE %(search_phrase)s OR
+            a.id IS NOT NULL
+        ORDER BY q.submission_time DESC, q.id, a.id
         """,
         {'search_phrase': search_phrase}
     )
-    answers = cursor.fetchall()
-    return answers
+    yield from cursor
 
 
 @connection.connection_handler
@@ -253,7 +534,8 @@ def user_id_for_answer(cursor, answer_id):
     cursor.execute("""
                     SELECT user_id
                     FROM answer
-                    WHERE id = %(answer_id)s
+                    WHERE id = %(answer_id)s AND
+                          submission_time = (SELECT submission_time FROM answer_key WHERE id = %(answer_id)s)
                     """, {'answer_id': answer_id})
     answer_data = cursor.fetchone()
     return answer_data['user_id']
@@ -264,13 +546,14 @@ def user_id_for_comment(cursor, comment_id):
     cursor.execute("""
                     SELECT user_id
                     FROM comment
-                    WHERE id = %(comment_id)s
+                    WHERE id = %(comment_id)s AND
+                          submission_time = (SELECT submission_time FROM comment_key WHERE id = %(comment_id)s)
                     """, {'comment_id': comment_id})
     comment_data = cursor.fetchone()
     return comment_data['user_id']
 
 
-@connection.connection_handler
+@connection.connection_handler(compact_rows=True)
 def questions_by_user_id(cursor, user_id):
     cursor.execute(
         """
@@ -285,7 +568,7 @@ def questions_by_user_id(cursor, user_id):
     return questions
 
 
-@connection.connection_handler
+@connection.connection_handler(compact_rows=True)
 def answers_by_user_id(cursor, user_id):
     cursor.execute(
         """
@@ -303,7 +586,7 @@ def answers_by_user_id(cursor, user_id):
     return answers
 
 
-@connection.connection_handler
+@connection.connection_handler(compact_rows=True)
 def comments_by_user_id(cursor, user_id):
     cursor.execute(
         """
@@ -323,7 +606,8 @@ def comments_by_user_id(cursor, user_id):
     return comments
 
 
-@connection.connection_handler
+# aggregates every user's posts, so it runs with the longer timeout of the reporting queries
+@connection.connection_handler(compact_rows=True, query_class='reporting')
 def user_stats(cursor):
     cursor.execute(
         """
@@ -361,3 +645,13 @@ def get_username_by_id(cursor, user_id):
                     """, {'user_id': user_id})
     name = cursor.fetchone()
     return name['username']
+
+
+@connection.connection_handler
+def user_id_range(cursor):
+    cursor.execute("""
+                    SELECT MIN(id) AS first_id, MAX(id) AS last_id
+                    FROM user_data
+                    """)
+    id_range = cursor.fetchone()
+    return id_range
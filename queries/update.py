@@ -1,5 +1,6 @@
 import connection
 from psycopg2 import sql
+from queries.select import PARTITIONED_TABLES, id_condition
 
 
 @connection.connection_handler
@@ -9,42 +10,39 @@ def entry(cursor, table, entry_updater):
             for key in entry_updater.keys()
     ]
 
-    query = sql.SQL("UPDATE {} SET {} WHERE id = {}").format(
+    query = sql.SQL("UPDATE {} SET {} WHERE {} RETURNING *").format(
         sql.Identifier(table),
         sql.SQL(', ').join(composable_sets),
-        sql.Placeholder('id')
+        id_condition(table, sql.Placeholder('id'))
     )
 
     cursor.execute(
         query,
         entry_updater
     )
+    updated_entry = cursor.fetchone()
+    return updated_entry
 
 
-@connection.connection_handler
-def increment_view_number(cursor, question_id):
-    cursor.execute(
-        """
-        UPDATE question
-        SET view_number = view_number + 1
-        WHERE id = %(question_id)s;
-        """,
-        {'question_id': question_id}
-    )
+connection.prepared_statement(
+    'increment_view_number',
+    """
+    UPDATE question
+    SET view_number = view_number + 1
+    WHERE id = $1
+    RETURNING view_number, version, updated_at
+    """
+)
 
 
 @connection.connection_handler
-def votes(cursor, vote_calculation, message_id, table):
-    cursor.execute(
-        sql.SQL("""
-                    UPDATE {table}
-                    SET vote_number = {vote_calculation}
-                    WHERE id={message_id}
-                    """)
-        .format(table=sql.Identifier(table),
-                vote_calculation=sql.SQL(vote_calculation),
-                message_id=sql.SQL(message_id))
-                )
+def increment_view_number(cursor, question_id):
+    """
+    :return: the new view_number, and the version and modification time of the question page
+    """
+    connection.execute_prepared(cursor, 'increment_view_number', (question_id,))
+    question = cursor.fetchone()
+    return question
 
 
 @connection.connection_handler
@@ -71,3 +69,230 @@ def reputation(cursor, reputation_calculation, user_id):
         .format(reputation_calculation=sql.SQL(reputation_calculation),
                 user_id=sql.SQL(user_id))
                   )
+
+
+# taken by the jobs writing the vote counters and reputations from the vote ledger, so they never run at the same time
+VOTE_COUNTERS_LOCK = "SELECT pg_advisory_xact_lock(hashtext('askmate_vote_counters'))"
+
+
+@connection.transaction_handler
+def apply_pending_votes(cursor, reputation_for_votes):
+    """
+    Adds the votes recorded in the ledger since the last run to the vote counters of the questions and answers,
+    and to the reputation of their authors, in one statement: every counter row is updated once per run
+    however many votes it got. A changed vote only adds the difference.
+    :param reputation_for_votes: {'question': {1: ..., -1: ...}, 'answer': {1: ..., -1: ...}}
+    :return: number of applied votes, and of updated questions, answers and users
+    """
+    cursor.execute(VOTE_COUNTERS_LOCK)
+    cursor.execute(
+        """
+        WITH pending AS (
+            SELECT user_id, target_type, target_id, value, applied_value
+            FROM vote
+            WHERE value <> applied_value
+            FOR UPDATE
+        ), applied AS (
+            UPDATE vote SET applied_value = pending.value
+            FROM pending
+            WHERE vote.user_id = pending.user_id AND
+                  vote.target_type = pending.target_type AND
+                  vote.target_id = pending.target_id
+            RETURNING pending.*
+        ), deltas AS (
+            SELECT
+                target_type, target_id,
+                SUM(value - applied_value) AS vote_delta,
+                SUM(
+                    CASE value WHEN 1 THEN up.reputation WHEN -1 THEN down.reputation ELSE 0 END -
+                    CASE applied_value WHEN 1 THEN up.reputation WHEN -1 THEN down.reputation ELSE 0 END
+                ) AS reputation_delta
+            FROM applied
+            JOIN (VALUES ('question', %(question_up)s), ('answer', %(answer_up)s)) up(type, reputation)
+                ON up.type = target_type
+            JOIN (VALUES ('question', %(question_down)s), ('answer', %(answer_down)s)) down(type, reputation)
+                ON down.type = target_type
+            GROUP BY target_type, target_id
+        ), updated_questions AS (
+            UPDATE question SET vote_number = COALESCE(vote_number, 0) + deltas.vote_delta
+            FROM deltas
+            WHERE deltas.target_type = 'question' AND question.id = deltas.target_id
+            RETURNING question.user_id, deltas.reputation_delta
+        ), updated_answers AS (
+            UPDATE answer SET vote_number = COALESCE(vote_number, 0) + deltas.vote_delta
+            FROM deltas
+            JOIN answer_key ON answer_key.id = deltas.target_id
+            WHERE deltas.target_type = 'answer' AND
+                  answer.id = answer_key.id AND answer.submission_time = answer_key.submission_time
+            RETURNING answer.user_id, deltas.reputation_delta
+        ), updated_users AS (
+            UPDATE user_data SET reputation = COALESCE(reputation, 0) + author.reputation_delta
+            FROM (
+                SELECT user_id, SUM(reputation_delta) AS reputation_delta
+                FROM (SELECT * FROM updated_questions UNION ALL SELECT * FROM updated_answers) updated
+                GROUP BY user_id
+            ) author
+            WHERE user_data.id = author.user_id
+            RETURNING user_data.id
+        )
+        SELECT
+            (SELECT COUNT(*) FROM applied) AS votes,
+            (SELECT COUNT(*) FROM updated_questions) AS questions,
+            (SELECT COUNT(*) FROM updated_answers) AS answers,
+            (SELECT COUNT(*) FROM updated_users) AS users
+        """,
+        {
+            'question_up': reputation_for_votes['question'][1],
+            'question_down': reputation_for_votes['question'][-1],
+            'answer_up': reputation_for_votes['answer'][1],
+            'answer_down': reputation_for_votes['answer'][-1]
+        }
+    )
+    applied = cursor.fetchone()
+    return applied
+
+
+# the reputation the users with ids between %(first)s and %(last)s earned from the votes already counted by
+# apply_pending_votes() and from their accepted answers, one row per vote or accepted answer
+EARNED_REPUTATION = """
+    SELECT question.user_id,
+           CASE vote.applied_value WHEN 1 THEN %(question_up)s WHEN -1 THEN %(question_down)s ELSE 0 END AS reputation
+    FROM question
+    JOIN vote ON vote.target_type = 'question' AND vote.target_id = question.id
+    WHERE question.user_id BETWEEN %(first)s AND %(last)s
+    UNION ALL
+    SELECT answer.user_id,
+           CASE vote.applied_value WHEN 1 THEN %(answer_up)s WHEN -1 THEN %(answer_down)s ELSE 0 END
+    FROM answer
+    JOIN vote ON vote.target_type = 'answer' AND vote.target_id = answer.id
+    WHERE answer.user_id BETWEEN %(first)s AND %(last)s
+    UNION ALL
+    SELECT answer.user_id, %(accepted)s
+    FROM answer
+    JOIN question ON question.accepted_answer_id = answer.id
+    WHERE answer.user_id BETWEEN %(first)s AND %(last)s
+"""
+
+
+@connection.transaction_handler
+def recalculated_reputation(cursor, first_user_id, last_user_id, reputation_for_votes, reputation_for_accepted_answer):
+    """
+    Recomputes the reputation of the users with ids between first_user_id and last_user_id from the votes
+    already counted by apply_pending_votes(), from the accepted answers, and from the reputation earned before
+    the vote ledger (user_data.legacy_reputation, see ask_mate_update.sql). Only the rows that change are written.
+    The users whose legacy_reputation isn't known yet get the part of their reputation these rules don't explain.
+    :return: number of changed users
+    """
+    parameters = {
+        'first': first_user_id,
+        'last': last_user_id,
+        'question_up': reputation_for_votes['question'][1],
+        'question_down': reputation_for_votes['question'][-1],
+        'answer_up': reputation_for_votes['answer'][1],
+        'answer_down': reputation_for_votes['answer'][-1],
+        'accepted': reputation_for_accepted_answer
+    }
+    cursor.execute(VOTE_COUNTERS_LOCK)
+    cursor.execute(
+        f"""
+        WITH earned AS ({EARNED_REPUTATION})
+        UPDATE user_data SET legacy_reputation = COALESCE(user_data.reputation, 0) - COALESCE(
+            (SELECT SUM(earned.reputation) FROM earned WHERE earned.user_id = user_data.id), 0)
+        WHERE user_data.id BETWEEN %(first)s AND %(last)s AND user_data.legacy_reputation IS NULL
+        """,
+        parameters
+    )
+    cursor.execute(
+        f"""
+        WITH earned AS ({EARNED_REPUTATION}), recalculated AS (
+            SELECT user_data.id, user_data.legacy_reputation + COALESCE(SUM(earned.reputation), 0) AS reputation
+            FROM user_data
+            LEFT JOIN earned ON earned.user_id = user_data.id
+            WHERE user_data.id BETWEEN %(first)s AND %(last)s
+            GROUP BY user_data.id
+        )
+        UPDATE user_data SET reputation = recalculated.reputation
+        FROM recalculated
+        WHERE user_data.id = recalculated.id AND user_data.reputation IS DISTINCT FROM recalculated.reputation
+        """,
+        parameters
+    )
+    return cursor.rowcount
+
+
+@connection.connection_handler
+def refreshed_hot_scores(cursor):
+    """
+    Adds the views since the last run to the hot scores of the questions, see refresh_hot_scores() in ask_mate_update.sql.
+    :return: number of updated questions
+    """
+    cursor.execute("SELECT refresh_hot_scores() AS questions")
+    refreshed = cursor.fetchone()
+    return refreshed['questions']
+
+
+@connection.connection_handler
+def question_similarity(cursor, indexed_questions):
+    """
+    Replaces the similarity index entries of the questions (see similarity.py).
+    :param indexed_questions: dictionaries with the id, minhash and similarity_buckets of the questions
+    """
+    bucket_question_ids = [question['id'] for question in indexed_questions
+                           for _ in question['similarity_buckets']]
+    cursor.execute(
+        """
+        DELETE FROM question_similarity_bucket WHERE question_id = ANY(%(question_ids)s::integer[]);
+
+        UPDATE question SET minhash = indexed.minhash
+        FROM unnest(%(question_ids)s::integer[], %(minhashes)s::bytea[]) AS indexed(id, minhash)
+        WHERE question.id = indexed.id;
+
+        -- a question deleted meanwhile isn't indexed
+        INSERT INTO question_similarity_bucket (bucket, question_id)
+        SELECT DISTINCT indexed.bucket, indexed.question_id
+        FROM unnest(%(buckets)s::bigint[], %(bucket_question_ids)s::integer[]) AS indexed(bucket, question_id)
+        JOIN question ON question.id = indexed.question_id;
+        """,
+        {
+            'question_ids': [question['id'] for question in indexed_questions],
+            'minhashes': [question['minhash'] for question in indexed_questions],
+            'buckets': [bucket for question in indexed_questions for bucket in question['similarity_buckets']],
+            'bucket_question_ids': bucket_question_ids
+        }
+    )
+
+
+@connection.connection_handler
+def created_partitions(cursor, months_ahead):
+    """
+    Creates the missing monthly partitions of the partitioned tables, from the current month to months_ahead months later.
+    :return: number of created partitions by table
+    """
+    cursor.execute(
+        """
+        SELECT parent, create_submission_time_partitions(
+            parent, LOCALTIMESTAMP, LOCALTIMESTAMP + make_interval(months => %(months_ahead)s)
+        ) AS created
+        FROM unnest(%(tables)s::text[]) parent
+        """,
+        {'tables': list(PARTITIONED_TABLES), 'months_ahead': months_ahead}
+    )
+    return {row['parent']: row['created'] for row in cursor.fetchall()}
+
+
+@connection.connection_handler
+def archived_partitions(cursor, months_kept, archive_tablespace):
+    """
+    Moves the monthly partitions older than the last months_kept months to archive_tablespace.
+    :return: number of moved partitions by table
+    """
+    cursor.execute(
+        """
+        SELECT parent, archive_submission_time_partitions(
+            parent, LOCALTIMESTAMP - make_interval(months => %(months_kept)s), %(tablespace)s
+        ) AS archived
+        FROM unnest(%(tables)s::text[]) parent
+        """,
+        {'tables': list(PARTITIONED_TABLES), 'months_kept': months_kept, 'tablespace': archive_tablespace}
+    )
+    return {row['parent']: row['archived'] for row in cursor.fetchall()}
@@ -0,0 +1,192 @@
+# Regression check of the database round trips of every route.
+# Seeds a scratch database, requests every route with the Flask test client, counts the connections taken
+# and the queries executed through connection.py, and compares them with query_counts_baseline.json.
+# Fails (exit status 1) if any route makes more round trips than its baseline, e.g. because of a new N+1 query.
+#
+# The database named in ASKMATE_QUERY_COUNT_DB is wiped and re-created, the other PSQL_* variables are used as usual:
+#     ASKMATE_QUERY_COUNT_DB=askmate_query_counts python query_counts.py
+#     ASKMATE_QUERY_COUNT_DB=askmate_query_counts python query_counts.py --update    (after an intended change)
+import argparse
+import io
+import json
+import os
+import sys
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'query_counts_baseline.json')
+SEED_FILES = ('sample_data/askmatepart2-sample-data.sql', 'ask_mate_update.sql')
+
+# (label, method, url, form data, logged in user); the writes come after the reads, in an order that keeps
+# every later request valid on the seeded data
+ROUTES = (
+    ('index', 'GET', '/', None, None),
+    ('list', 'GET', '/list', None, None),
+    ('list sorted', 'GET', '/list?order_by=title&order_direction=asc', None, None),
+    ('question', 'GET', '/question/1', None, None),
+    ('question logged in', 'GET', '/question/1', None, 'alice'),
+    ('search', 'GET', '/search?search_phrase=python', None, None),
+    ('tags', 'GET', '/tags', None, None),
+    ('tag questions', 'GET', '/tags/css', None, None),
+    ('tag autocomplete', 'GET', '/autocomplete/tags?q=c', None, None),
+    ('similar questions', 'GET', '/questions/similar?title=How+to+make+lists+in+Python', None, None),
+    ('user page', 'GET', '/user/1', None, None),
+    ('questions feed', 'GET', '/feed/questions', None, None),
+    ('tag feed', 'GET', '/feed/tags/css', None, None),
+    ('user feed', 'GET', '/user/1/feed', None, None),
+    ('users', 'GET', '/users', None, None),
+    ('login form', 'GET', '/login', None, None),
+    ('register form', 'GET', '/register', None, None),
+    ('new answer form', 'GET', '/question/1/new-answer', None, 'bob'),
+    ('edit question form', 'GET', '/question/1/edit', None, 'alice'),
+    ('edit answer form', 'GET', '/answer/1/edit', None, 'bob'),
+    ('new tag form', 'GET', '/question/1/new-tag', None, 'alice'),
+    ('answer comment form', 'GET', '/answer/1/1/new_comment', None, 'bob'),
+    ('question comment form', 'GET', '/question/1/new-comment', None, 'bob'),
+    ('edit comment form', 'GET', '/comments/1/edit', None, 'bob'),
+    ('delete comment form', 'GET', '/comment/1/delete', None, 'bob'),
+    ('login', 'POST', '/login', {'username': 'bob', 'password': 'bob'}, None),
+    ('register', 'POST', '/register', {'username': 'carol', 'password': 'carol'}, None),
+    ('vote', 'POST', '/question/1/vote', {'vote': 'Upvote,1,question'}, 'bob'),
+    ('new answer', 'POST', '/question/1/new-answer', {'message': 'Another answer', 'image': ''}, 'bob'),
+    ('new question comment', 'POST', '/question/1/new-comment', {'message': 'A comment'}, 'bob'),
+    ('new answer comment', 'POST', '/answer/1/1/new_comment', {'message': 'A comment'}, 'bob'),
+    ('edit comment', 'POST', '/comments/1/edit', {'message': 'Edited comment'}, 'bob'),
+    ('new tag', 'POST', '/question/1/new-tag', {'tag': 'new_tag', 'new_tag': 'jquery'}, 'alice'),
+    ('existing tag', 'POST', '/question/1/new-tag', {'tag': 'new_tag', 'new_tag': 'python'}, 'alice'),
+    ('delete tag', 'GET', '/question/1/tag/1/delete', None, 'alice'),
+    ('edit question', 'POST', '/question/1/edit', {'title': 'Edited title', 'message': 'Edited', 'image': ''}, 'alice'),
+    ('edit answer', 'POST', '/answer/1/edit', {'message': 'Edited answer', 'image': ''}, 'bob'),
+    ('accept answer', 'GET', '/question/1/1/accepted_answer', None, 'alice'),
+    ('add question', 'POST', '/add-question', {'title': 'A new question', 'message': 'Body', 'image': ''}, 'alice'),
+    ('delete comment', 'POST', '/comment/1/delete', {'delete-button': 'Yes'}, 'bob'),
+    ('delete answer', 'GET', '/question/1/2/delete', None, 'bob'),
+    ('delete question', 'GET', '/question/2/delete', None, 'alice'),
+    ('moderation delete', 'POST', '/moderation/delete', {'questions': '0'}, 'alice'),
+)
+
+# (label, url) of the pages answering conditional GETs, requested again with an If-None-Match matching anything
+NOT_MODIFIED_ROUTES = (
+    ('index not modified', '/'),
+    ('list not modified', '/list'),
+    ('question not modified', '/question/1'),
+    ('questions feed not modified', '/feed/questions'),
+)
+
+
+def seed_database():
+    import connection
+    import data_manager
+
+    db_connection = connection.open_database()
+    with db_connection.cursor() as cursor:
+        cursor.execute('DROP SCHEMA public CASCADE; CREATE SCHEMA public;')
+        for seed_file in SEED_FILES:
+            with open(seed_file) as sql_file:
+                cursor.execute(sql_file.read())
+    db_connection.close()
+
+    users = {username: data_manager.insert_user({'username': username, 'password': username})
+             for username in ('alice', 'bob')}
+
+    db_connection = connection.open_database()
+    with db_connection.cursor() as cursor:
+        cursor.execute("""
+                       UPDATE question SET user_id = %(alice)s;
+                       UPDATE answer SET user_id = %(bob)s;
+                       UPDATE comment SET user_id = %(bob)s, question_id = 1 WHERE question_id IS NULL;
+                       UPDATE comment SET user_id = %(bob)s, edited_count = COALESCE(edited_count, 0);
+                       """, users)
+    db_connection.close()
+    return users
+
+
+def count_round_trips(users):
+    import connection
+    import data_manager
+    import feeds
+    import server
+    import tag_index
+
+    os.environ['ASKMATE_MODERATORS'] = 'alice'
+    # a single process has nothing to learn from the invalidation listener, and its queries would run
+    # on another thread at any time, mixed into the counts of whichever route is being measured
+    server.app.before_request_funcs[None].remove(server.start_cache_invalidation_listener)
+    connection.prime_pool()
+    client = server.app.test_client()
+    counts = {}
+
+    requests = [route + ({},) for route in ROUTES]
+    requests += [(label, 'GET', url, None, None, {'If-None-Match': '*'}) for label, url in NOT_MODIFIED_ROUTES]
+    for label, method, url, form_data, username, headers in requests:
+        with client.session_transaction() as session:
+            session.clear()
+            session['url'] = '/'
+            if username:
+                session['username'] = username
+                session['user_id'] = users[username]
+
+        # every route is measured with cold caches, a cache hit must not hide a new query
+        data_manager.entity_cache.clear()
+        data_manager.search_cache.clear()
+        server.app.jinja_env.fragment_cache.clear()
+        feeds.feed_cache.clear()
+        # the autocomplete loads the cold index, which the tag writes don't refresh
+        tag_index.clear()
+
+        if form_data is not None:
+            form_data = {key: (io.BytesIO(b''), '') if key == 'image' else value for key, value in form_data.items()}
+        connection.statistics.update({'connections': 0, 'queries': 0})
+        # buffered, so a streamed page has run all of its queries when they are counted
+        response = client.open(url, method=method, data=form_data, headers=headers, buffered=True)
+        if response.status_code >= 400:
+            raise RuntimeError(f'{label}: {method} {url} answered {response.status_code}')
+        counts[label] = dict(connection.statistics)
+
+    return counts
+
+
+def compare(counts, baseline):
+    regressions = []
+    for label, count in counts.items():
+        expected = baseline.get(label)
+        if expected is None:
+            regressions.append(f'{label}: no baseline (run with --update)')
+            continue
+        for key in ('connections', 'queries'):
+            if count[key] > expected[key]:
+                regressions.append(f'{label}: {count[key]} {key}, baseline is {expected[key]}')
+            elif count[key] < expected[key]:
+                print(f'{label}: {count[key]} {key}, baseline is {expected[key]} (improved, run with --update)')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the database round trips of every route with the baseline.')
+    parser.add_argument('--update', action='store_true', help='write the current counts into the baseline file')
+    args = parser.parse_args()
+
+    if not os.environ.get('ASKMATE_QUERY_COUNT_DB'):
+        sys.exit('ASKMATE_QUERY_COUNT_DB has to name a scratch database, it is wiped by the check')
+    os.environ['PSQL_DB_NAME'] = os.environ['ASKMATE_QUERY_COUNT_DB']
+
+    users = seed_database()
+    counts = count_round_trips(users)
+
+    if args.update:
+        with open(BASELINE_FILE, 'w') as baseline_file:
+            json.dump(counts, baseline_file, indent=4)
+            baseline_file.write('\n')
+        print(f'Baseline written for {len(counts)} routes')
+        return
+
+    with open(BASELINE_FILE) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = compare(counts, baseline)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    if regressions:
+        sys.exit(1)
+    print(f'Database round trips of {len(counts)} routes are within the baseline')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Rate limiting and load shedding of the routes that are expensive for the database (see server.py's before_request).
+# Every client (IP address, and user when logged in) gets a token bucket per route class: a request takes a token,
+# the tokens are refilled at a fixed rate up to the burst size, and a request finding the bucket empty gets a 429.
+# When the database connections get scarce (requests wait for a free pooled connection), the search and listing
+# routes are refused with a 503 right away, so the connections are left to the cheap pages and the writes.
+import importlib
+import math
+import os
+import threading
+import time
+from collections import namedtuple
+import connection
+from cache import LRUCache
+
+# tokens added per second, and bucket size
+RateLimit = namedtuple('RateLimit', 'rate burst')
+
+
+def limit_from_env(route_class, rate, burst):
+    """The limit can be overridden with e.g. ASKMATE_RATE_LIMIT_SEARCH='0.5/10' (rate/burst)."""
+    value = os.environ.get(f'ASKMATE_RATE_LIMIT_{route_class.upper()}')
+    if value:
+        rate, burst = value.split('/')
+    return RateLimit(float(rate), float(burst))
+
+
+LIMITS = {
+    'search': limit_from_env('search', 0.5, 10),
+    'listing': limit_from_env('listing', 1, 20),
+    'write': limit_from_env('write', 0.2, 10)
+}
+
+# endpoint -> route class. The write routes are only limited on POST, their forms are cheap
+ROUTE_CLASSES = {
+    'route_search': 'search',
+    'route_similar_questions': 'search',
+    'route_users': 'listing',
+    'route_vote': 'write',
+    'route_add_question': 'write',
+    'route_new_answer': 'write',
+    'route_add_comment_to_question': 'write',
+    'route_add_comment_to_answer': 'write'
+}
+WRITE_METHODS = ('POST',)
+
+# route classes refused while the average wait for a pooled connection is above SHED_POOL_WAIT
+SHED_CLASSES = ('search', 'listing')
+SHED_POOL_WAIT = float(os.environ.get('ASKMATE_SHED_POOL_WAIT_MS', 100)) / 1000
+SHED_RETRY_AFTER = int(os.environ.get('ASKMATE_SHED_RETRY_AFTER', 10))
+
+
+class MemoryBackend:
+    """
+    Token buckets kept in this process, so every worker limits its own share of the requests.
+    A shared backend (limiting across workers and hosts) has to provide the same take() method,
+    see ASKMATE_RATE_LIMIT_BACKEND.
+    """
+
+    def __init__(self, max_buckets=100000):
+        # key -> (tokens, time of the last update), the least recently used clients are forgotten
+        self.buckets = LRUCache(max_buckets)
+        self._lock = threading.Lock()
+
+    def take(self, key, limit):
+        """
+        Takes a token from the bucket of key.
+        :return: 0 if there was a token, otherwise the seconds until the next one
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self.buckets.get(key, (limit.burst, now))
+            tokens = min(limit.burst, tokens + (now - updated_at) * limit.rate)
+            if tokens >= 1:
+                self.buckets.set(key, (tokens - 1, now))
+                return 0
+            self.buckets.set(key, (tokens, now))
+            return (1 - tokens) / limit.rate
+
+
+def load_backend():
+    """ASKMATE_RATE_LIMIT_BACKEND='module:factory' plugs in another backend, created by calling factory()."""
+    backend_path = os.environ.get('ASKMATE_RATE_LIMIT_BACKEND')
+    if not backend_path:
+        return MemoryBackend()
+    module_name, factory_name = backend_path.split(':')
+    return getattr(importlib.import_module(module_name), factory_name)()
+
+
+backend = load_backend()
+
+
+def route_class_for(endpoint, method):
+    route_class = ROUTE_CLASSES.get(endpoint)
+    if route_class == 'write' and method not in WRITE_METHODS:
+        return None
+    return route_class
+
+
+def check(endpoint, method, client_address, user_id=None):
+    """
+    :return: None if the request can be served, otherwise the (body, status, headers) to answer it with
+    """
+    route_class = route_class_for(endpoint, method)
+    if route_class is None:
+        return None
+
+    if route_class in SHED_CLASSES and connection.average_pool_wait() > SHED_POOL_WAIT:
+        return 'The site is busy, please try again later', 503, {'Retry-After': str(SHED_RETRY_AFTER)}
+
+    limit = LIMITS[route_class]
+    keys = [(route_class, 'ip', client_address)]
+    if user_id is not None:
+        keys.append((route_class, 'user', user_id))
+    retry_after = max(backend.take(key, limit) for key in keys)
+    if retry_after:
+        return 'Too many requests, please slow down', 429, {'Retry-After': str(math.ceil(retry_after))}
+    return None
@@ -0,0 +1,97 @@
+# Results of the recent searches, so a phrase searched again doesn't scan the questions and answers again.
+# The entries are keyed by the normalized phrase (see util.normalize_search_phrase()) and hold the texts of the found
+# questions and answers with the spans of the phrase in them, ready to be highlighted. Only result sets of up to
+# SEARCH_CACHE_MAX_RESULTS questions are kept: the large ones are streamed from the database every time
+# (see data_manager.py), and the cache is bounded by the characters of the texts it holds as well.
+# An entry is dropped when a question it shows changes, and when a new or edited post contains its phrase: the texts of
+# the posts written in another worker are read once their notifications arrive (see invalidation.py).
+import threading
+from collections import namedtuple
+import util
+from cache import SegmentedLRUCache
+
+# the spans are the (start, end) offsets of the occurrences of the phrase in the texts
+SearchResult = namedtuple('SearchResult', 'id submission_time title title_spans message message_spans answers')
+AnswerResult = namedtuple('AnswerResult', 'id message message_spans')
+
+# characters counted for a result besides its texts, for its tuples and offsets
+RESULT_OVERHEAD = 100
+
+
+def results_size(results):
+    """Approximate size of a list of SearchResult in characters, the weight of a cache entry."""
+    return sum(
+        RESULT_OVERHEAD + len(result.title or '') + len(result.message or '') +
+        sum(RESULT_OVERHEAD + len(answer.message or '') for answer in result.answers)
+        for result in results
+    )
+
+
+class SearchCache:
+    def __init__(self, max_size, ttl, max_chars):
+        self.entries = SegmentedLRUCache(max_size, ttl, on_evict=self._forget, max_weight=max_chars,
+                                         weigh=results_size)
+        # bumped by every invalidation, so results read while a post was written aren't stored, see set()
+        self.version = 0
+        # question id -> phrases whose results show the question, and the other way around
+        self._phrases_by_question = {}
+        self._questions_by_phrase = {}
+        # the entries call _forget() while their own lock is held, so this lock is always taken first
+        self._lock = threading.RLock()
+
+    def get(self, phrase):
+        with self._lock:
+            return self.entries.get(phrase)
+
+    def set(self, phrase, results, version):
+        """
+        :param results: list of SearchResult
+        :param version: self.version from before the results were read, they are only stored if nothing changed since
+        """
+        with self._lock:
+            if version != self.version:
+                return
+            self._forget(phrase)
+            self._questions_by_phrase[phrase] = [str(result.id) for result in results]
+            for question_id in self._questions_by_phrase[phrase]:
+                self._phrases_by_question.setdefault(question_id, set()).add(phrase)
+            # an entry too large for the cache is evicted (and forgotten) right away
+            self.entries.set(phrase, results)
+
+    def invalidate_question(self, question_id):
+        with self._lock:
+            self.version += 1
+            for phrase in self._phrases_by_question.pop(str(question_id), ()):
+                self.entries.delete(phrase)
+
+    def invalidate_text(self, *texts):
+        """Drops the entries whose phrase is in any of the texts of a new or edited post."""
+        texts = [text for text in texts if text]
+        with self._lock:
+            self.version += 1
+            for phrase in self.entries.keys():
+                if any(util.search_phrase_spans(phrase, text) for text in texts):
+                    self.entries.delete(phrase)
+
+    def _forget(self, phrase):
+        with self._lock:
+            for question_id in self._questions_by_phrase.pop(phrase, ()):
+                phrases = self._phrases_by_question.get(question_id)
+                if phrases is not None:
+                    phrases.discard(phrase)
+                    if not phrases:
+                        del self._phrases_by_question[question_id]
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self.entries.clear()
+            self._phrases_by_question.clear()
+            self._questions_by_phrase.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return self.entries.stats()
+
@@ -1,22 +1,73 @@
 from flask import \
     Flask, \
     render_template, \
+    stream_with_context, \
     request, \
     redirect, \
     url_for, \
     session, \
-    flash
+    flash, \
+    jsonify, \
+    abort, \
+    send_from_directory
+import connection
 import data_manager
+import itertools
 import os
 from werkzeug.utils import secure_filename
 import util
+import template_cache
+import compression
+import profiling
+import moderation
+import invalidation
+import rate_limit
+import http_cache
+import feeds
 
 UPLOAD_FOLDER = os.path.join(os.getcwd(), 'static/images')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+TAG_PAGE_SIZE = 20
+HOT_QUESTIONS = 10
+SIMILAR_QUESTIONS = 5
+# template events sent per chunk of a streamed page, so the page isn't sent (and compressed) a few bytes at a time
+STREAM_BUFFER_SIZE = 50
 
 app = Flask(__name__)
 app.secret_key = b'_5#y2L"F4Q8z\n\xec]/'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+template_cache.init_app(app)
+compression.init_app(app)
+feeds.init_app(app)
+# registered first, so the other before_request hooks are profiled as well
+profiling.init_app(app)
+
+
+@app.before_request
+def start_cache_invalidation_listener():
+    # the listener thread has to run in every worker process, so it is started (once) by the process' first request
+    invalidation.start()
+
+
+@app.before_request
+def limit_expensive_routes():
+    # answering with a response here skips the route
+    return rate_limit.check(request.endpoint, request.method, request.remote_addr, session.get('user_id'))
+
+
+@app.errorhandler(connection.DatabaseUnavailable)
+def database_unavailable(exception):
+    # the page mustn't need the database, see connection.CircuitBreaker
+    return (render_template('database_unavailable.html'), 503,
+            {'Retry-After': str(exception.retry_after), 'Cache-Control': 'no-store'})
+
+
+def stream_template(template_name, **context):
+    """Like render_template(), but the page is rendered while it is sent, see STREAM_BUFFER_SIZE."""
+    app.update_template_context(context)
+    template_stream = app.jinja_env.get_template(template_name).stream(context)
+    template_stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return app.response_class(stream_with_context(template_stream), mimetype='text/html')
 
 
 def allowed_file(filename):
@@ -40,13 +91,17 @@ def log_in_user(user_credentials):
     user_credentials_valid = data_manager.validate_user_credentials(user_credentials['username'],
                                                                     user_credentials['password'])
     if user_credentials_valid:
-        session['username'] = user_credentials['username']
-        session['user_id'] = data_manager.get_user_id_for(user_credentials['username'])
+        start_session(user_credentials['username'], data_manager.get_user_id_for(user_credentials['username']))
         return True
     else:
         return False
 
 
+def start_session(username, user_id):
+    session['username'] = username
+    session['user_id'] = user_id
+
+
 @app.route('/logout')
 def route_logout():
     session.pop('username', None)
@@ -62,8 +117,11 @@ def login_or_register():
         if request.form.get('login'):
             log_in_user(user_credentials)
         elif request.form.get('register'):
-            record_user(user_credentials)
-            log_in_user(user_credentials)
+            new_user_id = record_user(user_credentials)
+            if new_user_id:
+                start_session(user_credentials['username'], new_user_id)
+            else:
+                log_in_user(user_credentials)
         return redirect(session['url'])
 
     return render_template('home/login_or_register.html')
@@ -72,9 +130,15 @@ def login_or_register():
 @app.route("/")
 def route_index():
     session['url'] = url_for('route_index')
-    sorted_questions = data_manager.get_most_recent_questions()
+    list_version = data_manager.get_question_list_version()
+
+    def render():
+        sorted_questions = data_manager.get_most_recent_questions()
+        hot_questions = data_manager.get_hot_questions(HOT_QUESTIONS)
+        return render_template('home/index.html', sorted_questions=sorted_questions, hot_questions=hot_questions)
 
-    return render_template('home/index.html', sorted_questions=sorted_questions)
+    return http_cache.conditional_response(http_cache.page_etag('index', list_version['version']),
+                                           list_version['updated_at'], render)
 
 
 @app.route("/list")
@@ -92,9 +156,15 @@ def route_list():
     else:
         order_by, order = 'submission_time', 'desc'
 
-    sorted_questions = data_manager.get_all_questions(order_by, order)
-    return render_template('home/list.html', sorted_questions=sorted_questions,
-                           selected_sorting=order_by, selected_order=order)
+    list_version = data_manager.get_question_list_version()
+
+    def render():
+        sorted_questions = data_manager.get_all_questions(order_by, order)
+        return render_template('home/list.html', sorted_questions=sorted_questions,
+                               selected_sorting=order_by, selected_order=order)
+
+    return http_cache.conditional_response(http_cache.page_etag('list', list_version['version']),
+                                           list_version['updated_at'], render)
 
 
 def handle_image(image):
@@ -117,8 +187,7 @@ def route_add_question():
 
     user_inputs_for_question = request.form.to_dict()
     user_inputs_for_question['image'] = handle_image(request.files['image'])
-    data_manager.insert_question(user_inputs_for_question, session['user_id'])
-    new_id = data_manager.get_latest_id('question')
+    new_id = data_manager.insert_question(user_inputs_for_question, session['user_id'])
     return redirect(url_for('display_question_and_answers', question_id=new_id), code=307)
 
 
@@ -126,26 +195,38 @@ def route_add_question():
 def display_question_and_answers(question_id):
     session['url'] = url_for('display_question_and_answers', question_id=question_id)
 
-    if request.method == 'GET':
-        # update view number for question
-        data_manager.increment_view_number(question_id)
+    def render():
+        question_ids = data_manager.get_question_ids()
+        question = data_manager.get_single_question(question_id)
+        similar_questions = data_manager.get_questions_similar_to(question, SIMILAR_QUESTIONS) if question else []
+        user_id = session.get('user_id', False)
 
-    question_ids = data_manager.get_question_ids()
-    question = data_manager.get_single_question(question_id)
-    answers = data_manager.get_answers_for_question(question_id)
-    tags = data_manager.get_tags_for_question(question_id)
-    comments = data_manager.get_all_comments(question_id)
-    user_id = session.get('user_id', False)
+        # the tags, answers and comments are loaded by the template, only if their fragment isn't cached
+        return render_template('display_question/question_display.html', question=question,
+                               load_tags=lambda: data_manager.get_tags_for_question(question_id),
+                               load_answers=lambda: data_manager.get_answers_for_question(question_id),
+                               load_comments=lambda: data_manager.get_all_comments(question_id),
+                               question_ids=question_ids, user_id=user_id, similar_questions=similar_questions)
+
+    if request.method != 'GET':
+        return render()
 
-    return render_template('display_question/question_display.html', question=question, tags=tags,
-                           answers=answers, question_ids=question_ids, comments=comments, user_id=user_id)
+    # update view number for question, a revalidated page is a view as well
+    page_version = data_manager.increment_view_number(question_id)
+    if not page_version:
+        return render()
+    # the previous and next question links aren't part of the version, they may lag behind a new or deleted question
+    etag = http_cache.page_etag('question', question_id, page_version['version'])
+    return http_cache.conditional_response(etag, page_version['updated_at'], render)
 
 
 @app.route('/question/<question_id>/vote', methods=['POST'])
 def route_vote(question_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login_or_register'))
+
     vote_option, message_id, message_type = request.form['vote'].split(',')
-    data_manager.handle_votes(vote_option, message_id, message_type)
-    data_manager.handle_user_reputation(vote_option, message_id, message_type)
+    data_manager.handle_votes(vote_option, message_id, message_type, session['user_id'])
 
     # the code=307 argument ensures that the request type (POST) is preserved after redirection
     # so that the view number of the question doesn't increase after voting
@@ -155,7 +236,7 @@ def route_vote(question_id):
 @app.route('/question/<question_id>/<answer_id>/accepted_answer', methods=['GET'])
 def route_accepted_answer(question_id, answer_id):
     data_manager.handle_accepted_answer(question_id, answer_id)
-    data_manager.handle_user_reputation('accepted_answer', answer_id)
+    data_manager.handle_accepted_answer_reputation(answer_id)
 
     # the code=307 argument ensures that the request type (POST) is preserved after redirection
     # so that the view number of the question doesn't increase after voting
@@ -230,8 +311,6 @@ def route_edit_answer(answer_id):
 
 @app.route('/question/<question_id>/new-tag', methods=["GET", "POST"])
 def route_new_tag(question_id):
-    existing_tags = data_manager.get_existing_tags_for_question(question_id)
-
     if request.method == "POST":
         if request.form.get('tag') == "new_tag":
             new_tag = request.form.get('new_tag')
@@ -243,7 +322,7 @@ def route_new_tag(question_id):
         return redirect(url_for('display_question_and_answers', question_id=question_id), code=307)
 
     if data_manager.question_belongs_to_user(session.get('username'), question_id):
-        return render_template('database_ops/new_tag.html', existing_tags=existing_tags)
+        return render_template('database_ops/new_tag.html')
 
 
 @app.route('/question/<question_id>/tag/<tag_id>/delete')
@@ -293,9 +372,31 @@ def route_add_comment_to_question(question_id):
 
 @app.route('/search')
 def route_search():
-    search_phrase = request.args.get('search_phrase')
+    search_phrase = util.normalize_search_phrase(request.args.get('search_phrase'))
     search_results = data_manager.get_search_results(search_phrase)
-    return render_template('search/search_results.html', questions=search_results, search_phrase=search_phrase)
+    # the query runs and the first result is read before the response starts, so a database error still gets its
+    # error page instead of cutting short a page already sent with status 200. The other results are read and
+    # rendered while the page is sent, see data_manager.get_search_results()
+    first_result = next(search_results, None)
+    if first_result is not None:
+        search_results = itertools.chain([first_result], search_results)
+    return stream_template('search/search_results.html', questions=search_results, search_phrase=search_phrase)
+
+
+@app.route('/autocomplete/tags')
+def route_tag_autocomplete():
+    prefix = request.args.get('q', '')
+    tags = data_manager.get_tag_suggestions(prefix)
+    return jsonify(tags)
+
+
+@app.route('/questions/similar')
+def route_similar_questions():
+    """Suggestions for the question being written, see add-question.html."""
+    similar_questions = data_manager.get_similar_questions(request.args.get('title', ''),
+                                                           request.args.get('message', ''), SIMILAR_QUESTIONS,
+                                                           request.args.get('question_id'))
+    return jsonify(similar_questions)
 
 
 @app.route('/tags')
@@ -304,6 +405,82 @@ def route_tags():
     return render_template('home/tags.html', tags_counted=tags_counted)
 
 
+@app.route('/tags/<path:tag_name>')
+def route_tag_questions(tag_name):
+    tag = data_manager.get_tag_by_name(tag_name)
+    if not tag:
+        abort(404)
+
+    before_question_id = request.args.get('before', type=int)
+    questions = data_manager.get_questions_for_tag(tag['id'], before_question_id, TAG_PAGE_SIZE)
+    next_before = questions[-1].id if len(questions) == TAG_PAGE_SIZE else None
+    return render_template('home/tag_questions.html', tag=tag, sorted_questions=questions, next_before=next_before)
+
+
+def feed_response(key, build):
+    """
+    Serves an Atom feed from the feed cache (see feeds.py), with an ETag of its version.
+    :param key: tuple naming the feed, its parts joined with ':' name its version, e.g. ('tag', 3) -> 'tag:3'
+    :param build: function rendering the feed with the given updated time, returning None if there is no such feed
+    """
+    feed_version = data_manager.get_feed_version(':'.join(str(part) for part in key))
+    encoding = compression.accepted_encoding(request.headers.get('Accept-Encoding', ''))
+
+    def render():
+        feed = feeds.cached_feed(key, feed_version['version'], lambda: build(feed_version['updated_at']), encoding)
+        if feed is None:
+            abort(404)
+        body, body_encoding = feed
+        # already compressed, the compression middleware passes it on as it is
+        response = app.response_class(body, mimetype='application/atom+xml')
+        if body_encoding is not None:
+            response.headers['Content-Encoding'] = body_encoding
+        response.vary.add('Accept-Encoding')
+        return response
+
+    etag = http_cache.shared_etag('feed', *key, feed_version['version'])
+    return http_cache.conditional_response(etag, feed_version['updated_at'], render, shared=True)
+
+
+@app.route('/feed/questions')
+def route_questions_feed():
+    def build(updated):
+        entries = data_manager.get_recent_question_feed_entries(feeds.FEED_ENTRIES, feeds.SUMMARY_LENGTH)
+        return render_template('feeds/atom.xml', title='Recent questions', entries=entries, updated=updated,
+                               page_url=url_for('route_list', _external=True))
+
+    return feed_response(('questions',), build)
+
+
+@app.route('/feed/tags/<path:tag_name>')
+def route_tag_feed(tag_name):
+    # an unknown tag is a 404 even for a client sending an ETag, and the name (any text) stays out of the ETag
+    tag = data_manager.get_tag_by_name(tag_name)
+    if not tag:
+        abort(404)
+
+    def build(updated):
+        entries = data_manager.get_tag_question_feed_entries(tag['id'], feeds.FEED_ENTRIES, feeds.SUMMARY_LENGTH)
+        return render_template('feeds/atom.xml', title=f"Questions tagged {tag['name']}", entries=entries,
+                               updated=updated, page_url=url_for('route_tag_questions', tag_name=tag['name'],
+                                                                 _external=True))
+
+    return feed_response(('tag', tag['id']), build)
+
+
+@app.route('/user/<int:user_id>/feed')
+def route_user_feed(user_id):
+    def build(updated):
+        user_feed = data_manager.get_user_activity_feed(user_id, feeds.FEED_ENTRIES, feeds.SUMMARY_LENGTH)
+        if not user_feed:
+            return None
+        return render_template('feeds/atom.xml', title=f"{user_feed['username']}'s activity",
+                               entries=user_feed['entries'], updated=updated,
+                               page_url=url_for('route_user_page', user_id=user_id, _external=True))
+
+    return feed_response(('user', user_id), build)
+
+
 @app.route('/comment/<comment_id>/delete', methods=["GET", "POST"])
 def route_delete_comment(comment_id):
     comment = data_manager.get_single_entry('comment', comment_id)
@@ -345,12 +522,73 @@ def route_edit_comment(comment_id):
     return redirect(url_for('display_question_and_answers', question_id=question_id), code=307)
 
 
+@app.route('/moderation/delete', methods=['POST'])
+def route_moderation_delete():
+    """
+    Deletes many entries at once. Takes lists of ids under the keys 'questions', 'answers', 'comments' and 'users',
+    either as a JSON body or as repeated form fields.
+    :return: JSON report of everything that was deleted
+    """
+    if not moderation.is_moderator(session.get('username')):
+        return jsonify({'error': 'Only moderators can delete in bulk'}), 403
+
+    ids = request.get_json(silent=True) or request.form.to_dict(flat=False)
+    if not isinstance(ids, dict):
+        return jsonify({'error': 'Expected an object of id lists by entry type'}), 400
+    try:
+        ids_by_type = {entry_type: [int(entry_id) for entry_id in ids.get(entry_type, [])]
+                       for entry_type in moderation.ENTRY_TYPES}
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Ids must be integers'}), 400
+
+    deleted = moderation.remove_entries(**ids_by_type)
+    return jsonify(deleted)
+
+
+@app.route('/cache-stats')
+def route_cache_stats():
+    # the stats tell how loaded the worker and the database are, so they are for the moderators only
+    if not moderation.is_moderator(session.get('username')):
+        abort(403)
+
+    cache_stats = data_manager.get_cache_stats()
+    cache_stats['fragments'] = app.jinja_env.fragment_cache.stats()
+    cache_stats['feeds'] = feeds.stats()
+    cache_stats['database_circuit'] = connection.breaker.stats()
+    return jsonify(cache_stats)
+
+
+@app.route('/admin/hotspots')
+def route_hotspots():
+    """
+    Functions taking the most time in the recently profiled requests (see profiling.py),
+    optionally only in the requests of one route (?route=<endpoint name>).
+    """
+    if not moderation.is_moderator(session.get('username')):
+        abort(403)
+
+    route = request.args.get('route')
+    profiles = profiling.recent_profiles()
+    if route:
+        profiles = [profile for profile in profiles if profile['endpoint'] == route]
+    functions = profiling.hotspots(profiles)
+    return render_template('admin/hotspots.html', profiles=profiles, functions=functions, route=route)
+
+
+@app.route('/admin/profiles/<name>')
+def route_profile(name):
+    if not moderation.is_moderator(session.get('username')):
+        abort(403)
+    return send_from_directory(profiling.PROFILE_DIR, name + '.prof', as_attachment=True)
+
+
 @app.route('/register', methods=['GET', 'POST'])
 def route_register():
     if request.method == 'POST':
         user_data = request.form.to_dict()
-        if record_user(user_data):
-            log_in_user(user_data)
+        new_user_id = record_user(user_data)
+        if new_user_id:
+            start_session(user_data['username'], new_user_id)
             flash("Login successful")
         return redirect('/')
 
@@ -360,8 +598,8 @@ def route_register():
 def record_user(user_data):
     username_is_unique = data_manager.is_username_unique(user_data['username'])
     if username_is_unique:
-        data_manager.insert_user(user_data)
-        return True
+        new_user_id = data_manager.insert_user(user_data)
+        return new_user_id
 
 
 @app.route('/user/<user_id>')
@@ -0,0 +1,70 @@
+# MinHash signatures of the questions, for the similar question suggestions (question page, and the question form).
+# A question's text is cut into shingles (the title's words, and the pairs of consecutive words of the title and the
+# message), and the signature keeps the smallest value of every one of NUM_HASHES hash functions over the shingles:
+# the share of equal values in two signatures estimates the Jaccard similarity of the two sets of shingles.
+# The signature is split into BANDS bands, and every band is hashed into a bucket key stored in question_similarity_bucket
+# (see ask_mate_update.sql). Questions sharing a bucket are the candidates, so a lookup reads BANDS index entries instead
+# of comparing the question with every other one.
+import hashlib
+import random
+import re
+import struct
+
+BANDS = 20
+ROWS_PER_BAND = 3
+NUM_HASHES = BANDS * ROWS_PER_BAND
+# the first words of a long message are enough to tell what it is about, and keep the signature fast to compute
+MAX_MESSAGE_WORDS = 300
+
+MERSENNE_PRIME = (1 << 61) - 1
+# the hash functions must be the same in every process and after every restart, the stored signatures depend on them
+_random = random.Random(1807)
+HASH_PARAMETERS = [(_random.randrange(1, MERSENNE_PRIME), _random.randrange(MERSENNE_PRIME)) for _ in range(NUM_HASHES)]
+SIGNATURE_FORMAT = struct.Struct(f'<{NUM_HASHES}I')
+WORD = re.compile(r'\w+')
+
+
+def shingles(title, message):
+    title_words = WORD.findall((title or '').lower())
+    words = title_words + WORD.findall((message or '').lower())[:MAX_MESSAGE_WORDS]
+    return set(title_words) | {f'{first} {second}' for first, second in zip(words, words[1:])}
+
+
+def base_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'big') % MERSENNE_PRIME
+
+
+def signature(title, message):
+    """
+    :return: the MinHash signature of the question as NUM_HASHES 32 bit values, or None if it has no words
+    """
+    values = [base_hash(shingle) for shingle in shingles(title, message)]
+    if not values:
+        return None
+    # the values are cut to 32 bits when stored, unequal values rarely become equal that way
+    return [min((a * value + b) % MERSENNE_PRIME for value in values) & 0xffffffff for a, b in HASH_PARAMETERS]
+
+
+def buckets(signature_values):
+    """:return: the bucket key of every band, a signed 64 bit integer (a bigint) made of the band's number and values"""
+    keys = []
+    for band in range(BANDS):
+        rows = signature_values[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        digest = hashlib.blake2b(struct.pack(f'<H{ROWS_PER_BAND}I', band, *rows), digest_size=8).digest()
+        keys.append(int.from_bytes(digest, 'big', signed=True))
+    return keys
+
+
+def pack(signature_values):
+    """The signature as stored in question.minhash (4 bytes per value)."""
+    return SIGNATURE_FORMAT.pack(*signature_values)
+
+
+def unpack(stored_signature):
+    return list(SIGNATURE_FORMAT.unpack(bytes(stored_signature)))
+
+
+def estimated_similarity(signature_values, other_signature_values):
+    """:return: estimate of the Jaccard similarity of the two questions' shingles, between 0 and 1"""
+    equal = sum(value == other for value, other in zip(signature_values, other_signature_values))
+    return equal / NUM_HASHES
@@ -0,0 +1,100 @@
+# In-memory prefix index of the tag names for the tag autocomplete, weighted by the number of questions using a tag.
+# The names are kept in a sorted list, so the tags starting with a prefix are found with two binary searches.
+# Every worker loads the index on its first lookup, after that the tags are refreshed when they change
+# (by this worker's write functions, or by the cache invalidation listener for the other workers' writes,
+# once for all the tags of a burst of notifications).
+import bisect
+import heapq
+import threading
+from queries import select
+
+_sorted_names = []
+# lowercase name -> {'id': ..., 'name': ..., 'count': ...}
+_tags_by_name = {}
+_names_by_id = {}
+# short prefixes match a large part of the index, so their results are kept until the next change
+SHORT_PREFIX_LENGTH = 2
+# refreshing more tags than this at once reloads the whole index instead, e.g. after a bulk delete
+MAX_REFRESHED_TAGS = 100
+_short_prefix_results = {}
+_loaded = False
+_lock = threading.Lock()
+
+
+def load():
+    global _sorted_names, _tags_by_name, _names_by_id, _loaded
+    tags = select.tags_with_usage()
+    with _lock:
+        _tags_by_name = {tag['name'].lower(): dict(tag) for tag in tags if tag['name']}
+        _names_by_id = {tag['id']: key for key, tag in _tags_by_name.items()}
+        _sorted_names = sorted(_tags_by_name)
+        _short_prefix_results.clear()
+        _loaded = True
+
+
+def is_loaded():
+    return _loaded
+
+
+def clear():
+    """Forgets the index, the next lookup loads it again."""
+    global _sorted_names, _tags_by_name, _names_by_id, _loaded
+    with _lock:
+        _sorted_names, _tags_by_name, _names_by_id = [], {}, {}
+        _short_prefix_results.clear()
+        _loaded = False
+
+
+def refresh_tag(tag_id):
+    """Reloads a single tag (e.g. after it was created, or added to or removed from a question)."""
+    refresh_tags([tag_id])
+
+
+def refresh_tags(tag_ids):
+    """Reloads the given tags with one query, or the whole index if there are more than MAX_REFRESHED_TAGS."""
+    if not _loaded or not tag_ids:
+        return
+    if len(tag_ids) > MAX_REFRESHED_TAGS:
+        load()
+        return
+    tags = select.tags_with_usage_by_id(tag_ids)
+    with _lock:
+        _short_prefix_results.clear()
+        for tag_id in tag_ids:
+            _remove(tag_id)
+        for tag in tags:
+            if tag['name']:
+                key = tag['name'].lower()
+                if key not in _tags_by_name:
+                    bisect.insort(_sorted_names, key)
+                _tags_by_name[key] = dict(tag)
+                _names_by_id[tag['id']] = key
+
+
+def _remove(tag_id):
+    key = _names_by_id.pop(tag_id, None)
+    if key is not None and _tags_by_name.get(key, {}).get('id') == tag_id:
+        del _tags_by_name[key]
+        del _sorted_names[bisect.bisect_left(_sorted_names, key)]
+
+
+def search(prefix, limit=10):
+    """
+    :return: at most limit tags whose name starts with prefix (case insensitively), the most used ones first
+    """
+    if not _loaded:
+        load()
+
+    prefix = prefix.lower()
+    with _lock:
+        if len(prefix) <= SHORT_PREFIX_LENGTH and (prefix, limit) in _short_prefix_results:
+            return _short_prefix_results[(prefix, limit)]
+
+        start = bisect.bisect_left(_sorted_names, prefix)
+        end = bisect.bisect_left(_sorted_names, prefix + '\uffff', lo=start)
+        matches = [_tags_by_name[key] for key in _sorted_names[start:end]]
+        tags = heapq.nlargest(limit, matches, key=lambda tag: tag['count'])
+
+        if len(prefix) <= SHORT_PREFIX_LENGTH:
+            _short_prefix_results[(prefix, limit)] = tags
+    return tags
@@ -0,0 +1,49 @@
+# Template level caching: compiled templates are kept on disk so that a fresh worker doesn't recompile them,
+# and the {% cache %} tag keeps rendered fragments in memory.
+#
+# Usage in a template (every expression after the tag is a part of the key):
+#     {% cache 'answers', question.id, question.version, user_id %} ... {% endcache %}
+import os
+import tempfile
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from cache import LRUCache
+
+BYTECODE_CACHE_DIR = os.environ.get('ASKMATE_JINJA_CACHE_DIR',
+                                    os.path.join(tempfile.gettempdir(), 'askmate-jinja-cache'))
+FRAGMENT_CACHE_SIZE = int(os.environ.get('ASKMATE_FRAGMENT_CACHE_SIZE', 1000))
+# usernames and reputations shown inside the fragments are not part of the keys, so they are refreshed this often
+FRAGMENT_CACHE_TTL = int(os.environ.get('ASKMATE_FRAGMENT_CACHE_TTL', 300))
+
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=LRUCache(FRAGMENT_CACHE_SIZE, FRAGMENT_CACHE_TTL))
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        key_parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key_parts.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cached_fragment', [nodes.List(key_parts)]),
+                               [], [], body).set_lineno(lineno)
+
+    def _cached_fragment(self, key_parts, caller):
+        key = tuple(key_parts)
+        fragment = self.environment.fragment_cache.get(key)
+        if fragment is None:
+            fragment = caller()
+            self.environment.fragment_cache.set(key, fragment)
+        return fragment
+
+
+def init_app(app):
+    os.makedirs(BYTECODE_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(BYTECODE_CACHE_DIR)
+    app.jinja_env.add_extension(FragmentCacheExtension)
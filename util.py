@@ -1,3 +1,4 @@
+import re
 from datetime import datetime
 from queries import select
 from password import hash_password, verify_password
@@ -11,14 +12,6 @@ def handle_updated_comment(comment_data, updated_comment_message):
     return comment_data
 
 
-def is_duplicate_tag(tag_text):
-    existing_tags = select.tags_counted()
-    for tag in existing_tags:
-        if tag_text == tag['name']:
-            return True
-    return False
-
-
 def tag_belongs_to_question(question_id, tag_text):
     existing_tags = select.tags_for_question(question_id)
     for tag in existing_tags:
@@ -52,66 +45,36 @@ def amend_user_inputs_for_comment(new_comment_data):
     return new_comment_data
 
 
-def split_text_at_substring_occurrences(substr, text):
-    char_seq = []
-    current_split_point = 0
-    text_split = []
-
-    for i, char in enumerate(text):
-        char_seq.append(char)
+def normalize_search_phrase(search_phrase):
+    """Lower case, with every run of whitespace collapsed into a space: the phrase actually searched for."""
+    return ' '.join((search_phrase or '').lower().split())
 
-        if len(char_seq) < len(substr):
-            continue
 
-        if len(char_seq) > len(substr):
-            del char_seq[0]
+def search_phrase_spans(search_phrase, text):
+    """
+    :return: tuple of the (start, end) offsets of the (non-overlapping) occurrences of the phrase in the text,
+        ignoring case. The offsets are matched in the text itself, not in a lower-cased copy of it, whose offsets
+        drift wherever lower-casing changes the length of a character (e.g. 'İ')
+    """
+    if not search_phrase or not text:
+        return ()
+    return tuple(match.span() for match in re.finditer(re.escape(search_phrase), text, re.IGNORECASE))
 
-        current_substr = ''.join(char_seq)
-        if current_substr.lower() == substr.lower():
-            left_split_point = i - (len(substr) - 1)
-            text_split.append(text[current_split_point:left_split_point])
-            current_split_point = i + 1
-            text_split.append(text[left_split_point:current_split_point])
-        elif i == len(text) - 1:
-            text_split.append(text[current_split_point:])
 
+def split_text_at_spans(text, spans):
+    """
+    Splits the text into the parts between the occurrences and the occurrences themselves, to be highlighted:
+    the occurrences are the odd items of the list.
+    """
+    text_split = []
+    current_split_point = 0
+    for start, end in spans:
+        text_split += [text[current_split_point:start], text[start:end]]
+        current_split_point = end
+    text_split.append(text[current_split_point:])
     return text_split
 
 
-def split_text_values_in_search_results(search_results, text_keys, search_phrase):
-    for search_result in search_results:
-        for text_key in text_keys:
-            text = search_result[text_key]
-            if search_phrase.lower() in text.lower():
-                search_result[text_key] = split_text_at_substring_occurrences(search_phrase, text)
-            elif text_key == 'title':
-                search_result[text_key] = [text]
-            else:
-                search_result[text_key] = []
-    return search_results
-
-
-def get_answers_by_question_id(answers):
-    answers_by_question_id = {}
-    for answer in answers:
-        q_id = answer['question_id']
-        if q_id in answers_by_question_id:
-            answers_by_question_id[q_id].append(answer)
-        else:
-            answers_by_question_id[q_id] = [answer]
-    return answers_by_question_id
-
-
-def merge_answers_by_question_id_into_questions(answers_by_question_id, questions):
-    for question in questions:
-        q_id = question['id']
-        if q_id in answers_by_question_id:
-            question['answers'] = answers_by_question_id[q_id]
-        else:
-            question['answers'] = []
-    return questions
-
-
 def get_hashed_password(plain_text_password):
     return hash_password(plain_text_password)
 
@@ -129,8 +92,9 @@ def is_password_valid(plain_text_password, hashed_password):
 
 
 def format_datetime_in_query_results(query_results):
-    for record in query_results:
-        for key, value in record.items():
-            if isinstance(value, datetime):
-                record[key] = format_datetime(value)
+    # the records are named tuples (compact rows), so every record is replaced by a formatted copy
+    for index, record in enumerate(query_results):
+        formatted_values = {key: format_datetime(value)
+                            for key, value in record._asdict().items() if isinstance(value, datetime)}
+        query_results[index] = record._replace(**formatted_values)
     return query_results
@@ -0,0 +1,94 @@
+# Production entry point, served by gunicorn with the settings in gunicorn.conf.py:
+#     gunicorn wsgi:app
+# The app is imported once in the master process (templates compiled there are shared by the workers),
+# and every worker opens its own database connections after the fork, see warm_up_worker().
+import os
+import threading
+import psycopg2
+from werkzeug.middleware.proxy_fix import ProxyFix
+import connection
+import invalidation
+import server
+
+# number of proxies (e.g. the load balancer) in front of the app whose X-Forwarded-For and X-Forwarded-Proto are
+# trusted, so request.remote_addr (which the rate limits are kept by) is the client's address and not the proxy's
+PROXY_HOPS = int(os.environ.get('ASKMATE_PROXY_HOPS', 0))
+# seconds between the attempts to prime the pool of a worker started while the database was unavailable
+PRIME_RETRY_DELAY = 5
+
+_ready = False
+_stopping = threading.Event()
+
+
+def create_app():
+    app = server.app
+    app.config['DEBUG'] = False
+    if os.environ.get('ASKMATE_SECRET_KEY'):
+        app.secret_key = os.environ['ASKMATE_SECRET_KEY'].encode('utf-8')
+    if PROXY_HOPS:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS, x_proto=PROXY_HOPS)
+
+    app.add_url_rule('/health', 'route_health', route_health)
+    app.add_url_rule('/ready', 'route_ready', route_ready)
+
+    compile_templates(app)
+    return app
+
+
+def compile_templates(app):
+    # with the bytecode cache in place this mostly loads the already compiled templates from disk
+    for template_name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(template_name)
+
+
+def warm_up_worker():
+    """
+    Prepares a freshly forked worker: starts its listener thread (which reconnects by itself) and opens and primes
+    its connection pool. Called from gunicorn's post_fork, where an exception would stop the whole server, so
+    a database that is down only keeps /ready failing while the pool is primed again in the background.
+    """
+    _stopping.clear()
+    invalidation.start()
+    if not prime_pool():
+        threading.Thread(target=retry_priming, name='pool-priming', daemon=True).start()
+
+
+def prime_pool():
+    global _ready
+    try:
+        connection.prime_pool()
+    except (connection.DatabaseUnavailable, psycopg2.Error) as exception:
+        print(f'Priming the database pool failed: {exception}')
+        return False
+    _ready = True
+    return True
+
+
+def retry_priming():
+    while not _stopping.wait(PRIME_RETRY_DELAY):
+        if prime_pool():
+            return
+
+
+def shut_down_worker():
+    global _ready
+    _ready = False
+    _stopping.set()
+    invalidation.stop()
+    connection.close_pool()
+
+
+def route_health():
+    return 'OK'
+
+
+def route_ready():
+    if not _ready:
+        return 'Warming up', 503
+    # the load balancer can send the requests to workers still reaching the database
+    if connection.breaker.stats()['state'] == 'open':
+        return 'Database unavailable', 503
+    return 'Ready'
+
+
+app = create_app()